@@ -0,0 +1,273 @@
+import time
+import torch
+from collections import deque
+from torch.utils.data import DataLoader, Sampler
+from torch_geometric.data import Batch
+
+from utils import concat_ranges
+
+class PairBatchLoader:
+    """Batches of a DTAPairDataset (or a split view of it), collated with vectorized gathers.
+
+    Drug graphs are addressed through the dataset's CSR offsets (`drug_x_ptr`,
+    `drug_edge_ptr`), so a batch's `x`, `edge_index` and `batch` vectors are built
+    with a handful of index operations instead of collating one `Data` object per
+    pair. Batches hold the same tensors as the PyG DataLoader's.
+
+    With `dedup_drugs`, a batch holds every distinct drug graph once, and a
+    `drug_inverse` vector mapping each pair to its graph (see models.common.drug_graphs).
+    Batches with fewer than `DEDUP_MIN_PAIRS_PER_DRUG` pairs per distinct drug stay per
+    pair, as the unique-drug path's weighted batch norm costs more than it saves there.
+    With `dedup_proteins`, targets (or protein indices) are likewise collated once per
+    distinct protein, with a `prot_inverse` vector (see models.common.protein_targets).
+
+    With `num_workers`, batches are collated in background worker processes, up to
+    `prefetch_factor` batches ahead per worker; with `pin_memory` they are returned in
+    page-locked memory, ready for non-blocking transfers (see DevicePrefetcher). The
+    workers are started on the first epoch and kept for the later ones, which are fed
+    to them through an EpochBatchSampler.
+
+    With `buckets`, pairs are grouped by size before batching: the pairs are split into
+    `buckets` quantiles of protein sequence length, each crossed with `buckets` quantiles
+    of drug atom count, batches are cut from the pairs ordered by bucket (shuffled within
+    buckets) and, with `shuffle`, the batches themselves are shuffled. With
+    `truncate_targets`, sequence targets are cut after the longest protein of the batch
+    (rounded up to TARGET_LEN_MULTIPLE), as `target_len` for the protein table; this changes
+    the outputs of the models that accept it (see Vnoc_GINConvNet).
+
+    Batches are gathered on the device of the dataset's tensors: for a dataset made
+    resident with DTAPairDataset.to(device), every step is a handful of index operations
+    on the device (the permutation is drawn on the CPU, so runs do not depend on it).
+    """
+    DEDUP_MIN_PAIRS_PER_DRUG = 2
+    # Also above the receptive field of the Vnoc protein convolutions (3 * (16 - 1) + 1)
+    TARGET_LEN_MULTIPLE = 64
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, drop_last=False, generator=None, dedup_drugs=False,
+                 dedup_proteins=False, num_workers=0, pin_memory=False, prefetch_factor=2, buckets=0, truncate_targets=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.dedup_drugs = dedup_drugs
+        self.dedup_proteins = dedup_proteins
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
+        self.buckets = buckets
+        self.truncate_targets = truncate_targets
+        self._target_lengths = None
+        self._loader = None
+
+    def __getstate__(self):
+        # Worker processes started with spawn get the loader without its torch DataLoader
+        state = self.__dict__.copy()
+        state['_loader'] = None
+        return state
+
+    @property
+    def device(self):
+        return self.dataset.y.device
+
+    def pair_indices(self):
+        if self.dataset._indices is None:
+            return torch.arange(self.dataset.len(), device=self.device)
+        return torch.as_tensor(self.dataset._indices, device=self.device)
+
+    def target_lengths(self):
+        """Unpadded length of every protein's sequence target (None for ESM/DeepFRI encodings)."""
+        target = self.dataset.target
+        if target.is_floating_point():
+            return None
+        if self._target_lengths is None:
+            self._target_lengths = (target != 0).sum(1)
+        return self._target_lengths
+
+    def bucket_ids(self, indices):
+        """Size bucket of the pairs at `indices`, see the class docstring."""
+        dataset = self.dataset
+        drug_idx = dataset.drug_idx[indices]
+        sizes = [dataset.drug_x_ptr[drug_idx + 1] - dataset.drug_x_ptr[drug_idx]]
+        if self.target_lengths() is not None:
+            sizes.insert(0, self.target_lengths()[dataset.prot_idx[indices]])
+        bucket = torch.zeros_like(indices)
+        for size in sizes:
+            rank = torch.empty_like(indices)
+            rank[torch.argsort(size, stable=True)] = torch.arange(len(indices), device=indices.device)
+            bucket = bucket * self.buckets + rank * self.buckets // len(indices)
+        return bucket
+
+    def __len__(self):
+        num_pairs = len(self.dataset)
+        if self.drop_last:
+            return num_pairs // self.batch_size
+        return (num_pairs + self.batch_size - 1) // self.batch_size
+
+    def batches(self):
+        """Pair indices of every batch of one epoch, shuffled and bucketed as configured."""
+        indices = self.pair_indices()
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices), generator=self.generator).to(self.device)]
+        if self.buckets:
+            indices = indices[torch.argsort(self.bucket_ids(indices), stable=True)]
+        batches = [indices[batch_idx * self.batch_size:(batch_idx + 1) * self.batch_size] for batch_idx in range(len(self))]
+        if self.buckets and self.shuffle:
+            batches = [batches[batch_idx] for batch_idx in torch.randperm(len(batches), generator=self.generator).tolist()]
+        return batches
+
+    def __iter__(self):
+        if self.num_workers == 0 and not self.pin_memory:
+            for idx in self.batches():
+                yield self.collate(idx)
+            return
+
+        if self._loader is None:
+            if self.truncate_targets:
+                # Computed once here rather than in every worker
+                self.target_lengths()
+            # Each item of the torch loader is a whole batch's pair indices, collated by a worker
+            self._loader = DataLoader(BatchIndices(), sampler=EpochBatchSampler(self), batch_size=None, collate_fn=self.collate,
+                                      num_workers=self.num_workers, pin_memory=self.pin_memory, persistent_workers=self.num_workers > 0,
+                                      prefetch_factor=max(self.prefetch_factor, 1) if self.num_workers > 0 else None)
+        yield from self._loader
+
+    def collate(self, idx):
+        """Collates the pairs at (absolute) dataset indices `idx` into one batch."""
+        dataset = self.dataset
+        drug_idx = dataset.drug_idx[idx]
+        prot_idx = dataset.prot_idx[idx]
+        dedup = False
+        if self.dedup_drugs:
+            unique_idx, drug_inverse = torch.unique(drug_idx, return_inverse=True)
+            dedup = len(idx) >= self.DEDUP_MIN_PAIRS_PER_DRUG * len(unique_idx)
+            if dedup:
+                drug_idx = unique_idx
+
+        num_nodes = dataset.drug_x_ptr[drug_idx + 1] - dataset.drug_x_ptr[drug_idx]
+        num_edges = dataset.drug_edge_ptr[drug_idx + 1] - dataset.drug_edge_ptr[drug_idx]
+        ptr = torch.cat((num_nodes.new_zeros(1), num_nodes.cumsum(0)))
+
+        # Gather every pair's drug graph and shift its local edge indices by the graph's first node
+        x = dataset.drug_x[concat_ranges(dataset.drug_x_ptr[drug_idx], num_nodes)]
+        edge_index = dataset.drug_edge_index[:, concat_ranges(dataset.drug_edge_ptr[drug_idx], num_edges)] + \
+            torch.repeat_interleave(ptr[:-1], num_edges, output_size=int(num_edges.sum()))
+        batch = torch.repeat_interleave(torch.arange(len(drug_idx), device=x.device), num_nodes, output_size=x.size(0))
+
+        data = Batch(x=x, edge_index=edge_index, y=dataset.y[idx], batch=batch, ptr=ptr)
+        if self.dedup_proteins:
+            prot_idx, data.prot_inverse = torch.unique(prot_idx, return_inverse=True)
+        target_len = dataset.target.size(1)
+        if self.truncate_targets and self.target_lengths() is not None:
+            multiple = self.TARGET_LEN_MULTIPLE
+            target_len = min(-(-int(self.target_lengths()[prot_idx].max()) // multiple) * multiple, target_len)
+            data.target_len = target_len
+        if dataset.protein_lookup:
+            data.prot_idx = prot_idx
+        else:
+            data.target = dataset.target[prot_idx, :target_len]
+        if dedup:
+            data.drug_inverse = drug_inverse
+            num_nodes = num_nodes[drug_inverse]
+        data.c_size = num_nodes
+        data.fold = dataset.fold[idx]
+        return data
+
+class EpochBatchSampler(Sampler):
+    """Samples the batches of a PairBatchLoader, drawing a new epoch's batches every time it is iterated."""
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __iter__(self):
+        # Drawn lazily: the torch DataLoader creates (and discards) a sampler iterator more than once per epoch
+        yield from self.loader.batches()
+
+    def __len__(self):
+        return len(self.loader)
+
+class BatchIndices:
+    """Identity map from the batches of an EpochBatchSampler to the torch DataLoader's collate_fn."""
+    def __getitem__(self, idx):
+        return idx
+
+class DevicePrefetcher:
+    """Moves the batches of `loader` to `device`, issuing transfers `depth` batches ahead (0: on demand).
+
+    On CUDA, transfers are non-blocking copies (from pinned memory, see PairBatchLoader)
+    on a side stream, so the next batches are copied while the current one is used.
+    `wait_time` is the time the last iteration spent blocked on `loader` for batches.
+    """
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.wait_time = 0.0
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        queue = deque()
+        self.wait_time = 0.0
+
+        def issue():
+            start = time.perf_counter()
+            data = next(batches, None)
+            self.wait_time += time.perf_counter() - start
+            if data is None:
+                return
+            if stream is None:
+                queue.append((data.to(self.device), None))
+                return
+            with torch.cuda.stream(stream):
+                data = data.to(self.device, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(stream)
+            queue.append((data, event))
+
+        for _ in range(self.depth):
+            issue()
+        while True:
+            if not queue:
+                issue()
+                if not queue:
+                    break
+            data, event = queue.popleft()
+            if event is not None:
+                torch.cuda.current_stream(self.device).wait_event(event)
+                # Tensors allocated on the side stream are now used on the current one
+                for _, value in data:
+                    if isinstance(value, torch.Tensor):
+                        value.record_stream(torch.cuda.current_stream(self.device))
+            if self.depth > 0:
+                issue()
+            yield data
+
+class CachedBatches:
+    """Batches of `loader`, collated and moved to the device by the first iteration and replayed by every later one.
+
+    Meant for fixed (unshuffled) evaluation sets: evaluating them every epoch then costs
+    only forward passes. Batches are kept as the caller leaves them, so expand_compact
+    also runs on each batch only once.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.batches = None
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.batches is None:
+            self.batches = list(self.loader)
+        return iter(self.batches)
@@ -0,0 +1,122 @@
+# Run from the repository root: python -m benchmarks.amp
+import sys
+import time
+import argparse
+import torch
+import torch.nn as nn
+from utils import DTAPairDataset, expand_compact, amp_dtype, mse, ci
+from batching import PairBatchLoader
+from models import all_models, model_target_types
+
+def run(modeling, train_batches, test_batches, device, dtype, epochs):
+    """Trains a fresh model on the batches, returning its step times, memory and test predictions.
+
+    Memory is the size of the tensors saved for the backward pass of a training step, and
+    on CUDA also the peak allocated memory.
+    """
+    torch.manual_seed(0)
+    model = modeling().to(device)
+    loss_fn = nn.MSELoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.0005)
+    scaler = torch.amp.GradScaler(device.type) if dtype == torch.float16 else None
+    saved = []
+
+    def pack(tensor):
+        saved[-1] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    model.train()
+    train_time = 0.0
+    for epoch in range(epochs):
+        for data in train_batches:
+            start = time.perf_counter()
+            data = expand_compact(data.to(device))
+            optimizer.zero_grad()
+            saved.append(0)
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                with torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+                    output = model(data)
+                loss = loss_fn(output.float(), data.y.view(-1, 1).float())
+            if scaler is None:
+                loss.backward()
+                optimizer.step()
+            else:
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            train_time += time.perf_counter() - start
+    peak = torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else None
+
+    model.eval()
+    preds, labels = [], []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for data in test_batches:
+            data = expand_compact(data.to(device))
+            with torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+                preds.append(model(data).float().cpu())
+            labels.append(data.y.view(-1, 1).cpu())
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    eval_time = time.perf_counter() - start
+    num_train = sum(data.y.numel() for data in train_batches) * epochs
+    num_test = sum(data.y.numel() for data in test_batches)
+    return {'train': num_train / train_time, 'eval': num_test / eval_time, 'saved': max(saved), 'peak': peak,
+            'G': torch.cat(labels).numpy().flatten(), 'P': torch.cat(preds).numpy().flatten()}
+
+parser = argparse.ArgumentParser(description="Compare mixed precision against fp32 training and inference, per model.")
+parser.add_argument('--dataset', type=str, default='davis', choices=['davis', 'kiba'],
+                    help="Dataset to train on (default: davis).")
+parser.add_argument('--models', type=str, nargs='+', default=list(all_models.keys()), choices=list(all_models.keys()),
+                    help="Models to compare (default: all).")
+parser.add_argument('--amp', type=str, default='bf16', choices=['bf16', 'fp16'],
+                    help="Mixed precision autocast type, fp16 on CUDA only (default: bf16).")
+parser.add_argument('--batch_size', type=int, default=512,
+                    help="Batch size (default: 512).")
+parser.add_argument('--num_batches', type=int, default=4,
+                    help="Number of training batches, and of test batches (default: 4).")
+parser.add_argument('--epochs', type=int, default=3,
+                    help="Number of passes over the training batches (default: 3).")
+parser.add_argument('--mse_tolerance', type=float, default=0.05,
+                    help="Largest accepted relative change in test MSE against fp32 (default: 0.05).")
+parser.add_argument('--ci_tolerance', type=float, default=0.01,
+                    help="Largest accepted change in test CI against fp32 (default: 0.01).")
+parser.add_argument('--cuda', type=int, default=0,
+                    help="CUDA device index, if available (default: 0).")
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    device = torch.device(f"cuda:{args.cuda}" if torch.cuda.is_available() else "cpu")
+    dtype = amp_dtype(args.amp, device)
+    failed = []
+    for model_name in args.models:
+        modeling = all_models[model_name]
+        target_type = model_target_types.get(model_name)
+        train_dataset, _, test_dataset = DTAPairDataset(root='data', dataset=args.dataset, target_type=target_type).split()
+        generator = torch.Generator().manual_seed(0)
+        train_batches = [data for data, _ in zip(PairBatchLoader(train_dataset, batch_size=args.batch_size, shuffle=True,
+                                                                 generator=generator), range(args.num_batches))]
+        test_batches = [data for data, _ in zip(PairBatchLoader(test_dataset, batch_size=args.batch_size, shuffle=True,
+                                                                generator=generator), range(args.num_batches))]
+
+        fp32 = run(modeling, train_batches, test_batches, device, None, args.epochs)
+        half = run(modeling, train_batches, test_batches, device, dtype, args.epochs)
+        fp32_mse, half_mse = mse(fp32['G'], fp32['P']), mse(half['G'], half['P'])
+        fp32_ci, half_ci = ci(fp32['G'], fp32['P']), ci(half['G'], half['P'])
+        ok = abs(half_mse - fp32_mse) <= args.mse_tolerance * fp32_mse and abs(half_ci - fp32_ci) <= args.ci_tolerance
+        if not ok:
+            failed.append(model_name)
+
+        memory = f"saved activations {fp32['saved'] / 2**20:.0f} -> {half['saved'] / 2**20:.0f} MB"
+        if fp32['peak'] is not None:
+            memory += f", peak {fp32['peak'] / 2**20:.0f} -> {half['peak'] / 2**20:.0f} MB"
+        print(f"{model_name} {args.amp}: train {fp32['train']:.0f} -> {half['train']:.0f} pairs/s "
+              f"({half['train'] / fp32['train']:.2f}x), eval {fp32['eval']:.0f} -> {half['eval']:.0f} pairs/s "
+              f"({half['eval'] / fp32['eval']:.2f}x), {memory}, "
+              f"test MSE {fp32_mse:.4f} -> {half_mse:.4f}, CI {fp32_ci:.4f} -> {half_ci:.4f} ({'ok' if ok else 'OUT OF TOLERANCE'})")
+    if failed:
+        sys.exit(f"Out of tolerance against fp32: {', '.join(failed)}")
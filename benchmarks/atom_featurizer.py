@@ -0,0 +1,49 @@
+# Run from the repository root: python -m benchmarks.atom_featurizer
+import json
+import time
+import argparse
+import numpy as np
+from collections import OrderedDict
+from rdkit import Chem, RDLogger
+from utils import atom_features, atom_feature_indices, atom_feature_matrix
+
+RDLogger.DisableLog('rdApp.*')
+
+def per_atom_features(mol):
+    features = []
+    for atom in mol.GetAtoms():
+        feature = atom_features(atom)
+        features.append( feature / sum(feature) )
+    return np.array(features)
+
+def table_features(mol):
+    return atom_feature_matrix(atom_feature_indices(mol))
+
+def time_featurizer(featurizer, mols, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for mol in mols:
+            featurizer(mol)
+        best = min(best, time.perf_counter() - start)
+    return best / len(mols)
+
+parser = argparse.ArgumentParser(description="Benchmark the per-atom and table-driven atom featurizers.")
+parser.add_argument('--datasets', type=str, nargs='+', default=['davis', 'kiba'],
+                    help="Datasets whose drugs.json is featurized (default: davis kiba).")
+parser.add_argument('--repeats', type=int, default=5,
+                    help="Number of timing repeats, the best one is reported (default: 5).")
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    for dataset in args.datasets:
+        ligands = json.load(open(f"data/{dataset}/drugs.json"), object_pairs_hook=OrderedDict)
+        mols = [Chem.MolFromSmiles(Chem.MolToSmiles(Chem.MolFromSmiles(smile), isomericSmiles=True)) for smile in ligands.values()]
+
+        for mol in mols:
+            assert np.array_equal(per_atom_features(mol), table_features(mol)), "Featurizers disagree!"
+
+        old = time_featurizer(per_atom_features, mols, args.repeats)
+        new = time_featurizer(table_features, mols, args.repeats)
+        print(f"{dataset}: {len(mols)} molecules, per-atom {old * 1e6:.1f} us/mol, "
+              f"table-driven {new * 1e6:.1f} us/mol, speedup {old / new:.2f}x")
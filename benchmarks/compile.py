@@ -0,0 +1,63 @@
+# Run from the repository root: python -m benchmarks.compile
+import time
+import argparse
+import torch
+import torch.nn as nn
+from torch._dynamo.utils import counters
+from utils import DTAPairDataset, expand_compact, compile_model
+from batching import PairBatchLoader
+from models import all_models, model_target_types
+
+def time_steps(model, batches, train):
+    """Time of the first training step (or inference forward pass) over the batches, and the mean time of the others."""
+    loss_fn = nn.MSELoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.0005)
+    model.train(train)
+    times = []
+    for data in batches:
+        start = time.perf_counter()
+        data = expand_compact(data)
+        if train:
+            optimizer.zero_grad()
+            loss = loss_fn(model(data), data.y.view(-1, 1).float())
+            loss.backward()
+            optimizer.step()
+        else:
+            with torch.no_grad():
+                model(data)
+        times.append(time.perf_counter() - start)
+    return times[0], sum(times[1:]) / (len(times) - 1)
+
+parser = argparse.ArgumentParser(description="Benchmark CPU step times of eager against torch.compile'd models.")
+parser.add_argument('--dataset', type=str, default='davis', choices=['davis', 'kiba'],
+                    help="Dataset to batch (default: davis).")
+parser.add_argument('--models', type=str, nargs='+', default=list(all_models.keys()), choices=list(all_models.keys()),
+                    help="Models to time (default: all).")
+parser.add_argument('--batch_size', type=int, default=512,
+                    help="Batch size (default: 512).")
+parser.add_argument('--num_batches', type=int, default=6,
+                    help="Number of shuffled training batches timed, the first one is a warm-up (default: 6).")
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    for model_name in args.models:
+        modeling = all_models[model_name]
+        target_type = model_target_types.get(model_name)
+        train_dataset, _, _ = DTAPairDataset(root='data', dataset=args.dataset, target_type=target_type).split()
+        loader = PairBatchLoader(train_dataset, batch_size=args.batch_size, shuffle=True, generator=torch.Generator().manual_seed(0))
+        batches = [data for data, _ in zip(loader, range(args.num_batches))]
+
+        torch.manual_seed(0)
+        model = modeling()
+        compiled = compile_model(model)
+        for train in [True, False]:
+            _, eager = time_steps(model, batches, train)
+            counters.clear()
+            first, steady = time_steps(compiled, batches, train)
+            graph_breaks = sum(counters['graph_break'].values())
+            print(f"{args.dataset} {model_name} {'train' if train else 'eval'}: eager {eager * 1e3:.1f} ms/batch, "
+                  f"compiled {steady * 1e3:.1f} ms/batch (first batch {first:.1f} s, {graph_breaks} graph breaks), "
+                  f"speedup {eager / steady:.2f}x")
+        with torch.no_grad():
+            diff = max(float((model(data) - compiled(data)).abs().max()) for data in batches)
+        print(f"{args.dataset} {model_name}: max abs difference of compiled from eager predictions {diff:.2e}")
@@ -0,0 +1,58 @@
+# Run from the repository root: python -m benchmarks.data_wait
+import time
+import argparse
+import torch
+import torch.nn as nn
+from utils import DTAPairDataset, expand_compact
+from batching import PairBatchLoader, DevicePrefetcher
+from models.ginconv import GINConvNet
+
+def run_epoch(model, loader, device, num_batches):
+    """Trains on up to `num_batches` batches, returning the data wait and total time per batch."""
+    loss_fn = nn.MSELoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.0005)
+    model.train()
+    start = time.perf_counter()
+    for batch_idx, data in enumerate(loader):
+        data = expand_compact(data.to(device))
+        optimizer.zero_grad()
+        loss = loss_fn(model(data), data.y.view(-1, 1).float())
+        loss.backward()
+        optimizer.step()
+        if batch_idx + 1 == num_batches:
+            break
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    total = time.perf_counter() - start
+    return loader.wait_time / (batch_idx + 1), total / (batch_idx + 1)
+
+parser = argparse.ArgumentParser(description="Benchmark the time training waits for batches, per loader configuration.")
+parser.add_argument('--dataset', type=str, default='davis', choices=['davis', 'kiba'],
+                    help="Dataset to train on (default: davis).")
+parser.add_argument('--batch_size', type=int, default=512,
+                    help="Batch size (default: 512).")
+parser.add_argument('--num_batches', type=int, default=20,
+                    help="Number of training batches timed per configuration, 0 for a full epoch (default: 20).")
+parser.add_argument('--loader_workers', type=int, nargs='+', default=[0, 2],
+                    help="Numbers of collating worker processes to compare (default: 0 2).")
+parser.add_argument('--prefetch', type=int, nargs='+', default=[0, 2],
+                    help="Prefetch depths to compare (default: 0 2).")
+parser.add_argument('--cuda', type=int, default=0,
+                    help="CUDA device index, if available (default: 0).")
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    device = torch.device(f"cuda:{args.cuda}" if torch.cuda.is_available() else "cpu")
+    train_dataset, _, _ = DTAPairDataset(root='data', dataset=args.dataset).split()
+
+    for num_workers in args.loader_workers:
+        for depth in args.prefetch:
+            torch.manual_seed(0)
+            model = GINConvNet().to(device)
+            loader = DevicePrefetcher(PairBatchLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=num_workers,
+                                                      pin_memory=device.type == 'cuda', prefetch_factor=depth), device, depth=depth)
+            num_batches = args.num_batches or len(loader)
+            wait, total = run_epoch(model, loader, device, num_batches)
+            print(f"{args.dataset} workers {num_workers} prefetch {depth}: data wait {wait * 1e3:.2f} ms/batch "
+                  f"({wait * len(loader):.2f} s/epoch), step {total * 1e3:.1f} ms/batch, "
+                  f"data wait {100 * wait / total:.1f}% of training time")
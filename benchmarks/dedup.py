@@ -0,0 +1,76 @@
+# Run from the repository root: python -m benchmarks.dedup
+import time
+import argparse
+import torch
+import torch.nn as nn
+from utils import DTAPairDataset, expand_compact
+from batching import PairBatchLoader
+from models import all_models, model_target_types
+
+def time_steps(model, batches, device, train):
+    """Mean time of a training step (or an inference forward pass) over the batches, after one warm-up batch."""
+    loss_fn = nn.MSELoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.0005)
+    model.train(train)
+    total = 0.0
+    for batch_idx, data in enumerate(batches):
+        start = time.perf_counter()
+        data = expand_compact(data.to(device))
+        if train:
+            optimizer.zero_grad()
+            loss = loss_fn(model(data), data.y.view(-1, 1).float())
+            loss.backward()
+            optimizer.step()
+        else:
+            with torch.no_grad():
+                model(data)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        if batch_idx > 0:
+            total += time.perf_counter() - start
+    return total / (len(batches) - 1)
+
+parser = argparse.ArgumentParser(description="Benchmark models on per-pair against unique-drug/unique-protein batches.")
+parser.add_argument('--datasets', type=str, nargs='+', default=['davis', 'kiba'],
+                    help="Datasets to batch (default: davis kiba).")
+parser.add_argument('--models', type=str, nargs='+', default=['GINConvNet', 'GATNet'], choices=list(all_models.keys()),
+                    help="Models to time (default: GINConvNet GATNet).")
+parser.add_argument('--dedup', type=str, nargs='+', default=['drugs'], choices=['drugs', 'proteins'],
+                    help="What the deduplicated batches hold once per batch (default: drugs).")
+parser.add_argument('--batch_size', type=int, default=512,
+                    help="Batch size (default: 512).")
+parser.add_argument('--num_batches', type=int, default=6,
+                    help="Number of shuffled training batches timed, the first one is a warm-up (default: 6).")
+parser.add_argument('--repeats', type=int, default=3,
+                    help="Number of alternating timing repeats, the best one is reported (default: 3).")
+parser.add_argument('--cuda', type=int, default=0,
+                    help="CUDA device index, if available (default: 0).")
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    device = torch.device(f"cuda:{args.cuda}" if torch.cuda.is_available() else "cpu")
+    for dataset in args.datasets:
+        for model_name in args.models:
+            modeling = all_models[model_name]
+            target_type = model_target_types.get(model_name)
+            train_dataset, _, _ = DTAPairDataset(root='data', dataset=dataset, target_type=target_type).split()
+
+            batch_idx = torch.randperm(len(train_dataset), generator=torch.Generator().manual_seed(0))
+            batch_idx = torch.as_tensor(train_dataset._indices)[batch_idx[:args.batch_size * args.num_batches]].view(args.num_batches, -1)
+            per_pair = [PairBatchLoader(train_dataset).collate(idx) for idx in batch_idx]
+            unique = [PairBatchLoader(train_dataset, dedup_drugs='drugs' in args.dedup,
+                                      dedup_proteins='proteins' in args.dedup).collate(idx) for idx in batch_idx]
+            num_drugs = sum(train_dataset.drug_idx[idx].unique().numel() for idx in batch_idx) / len(batch_idx)
+            num_proteins = sum(train_dataset.prot_idx[idx].unique().numel() for idx in batch_idx) / len(batch_idx)
+            num_dedup = sum('drug_inverse' in data for data in unique)
+
+            for train in [True, False]:
+                torch.manual_seed(0)
+                model = modeling().to(device)
+                old, new = float('inf'), float('inf')
+                for _ in range(args.repeats):
+                    old = min(old, time_steps(model, per_pair, device, train))
+                    new = min(new, time_steps(model, unique, device, train))
+                print(f"{dataset} {model_name} {'train' if train else 'eval'}: {num_drugs:.0f} drugs, {num_proteins:.0f} proteins "
+                      f"per {args.batch_size} pairs ({num_dedup}/{args.num_batches} batches with unique drugs), "
+                      f"per-pair {old * 1e3:.1f} ms/batch, deduplicated {new * 1e3:.1f} ms/batch, speedup {old / new:.2f}x")
@@ -0,0 +1,43 @@
+# Run from the repository root: python -m benchmarks.pair_collate
+import time
+import argparse
+import torch
+from torch_geometric.loader import DataLoader
+from utils import DTAPairDataset
+from batching import PairBatchLoader
+
+def time_loader(loader, num_batches, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for batch_idx, _ in enumerate(loader):
+            if batch_idx + 1 == num_batches:
+                break
+        best = min(best, time.perf_counter() - start)
+    return best / min(num_batches, len(loader))
+
+parser = argparse.ArgumentParser(description="Benchmark the PyG DataLoader collate against the vectorized PairBatchLoader.")
+parser.add_argument('--datasets', type=str, nargs='+', default=['davis', 'kiba'],
+                    help="Datasets to batch (default: davis kiba).")
+parser.add_argument('--batch_size', type=int, default=512,
+                    help="Batch size (default: 512).")
+parser.add_argument('--num_batches', type=int, default=50,
+                    help="Number of shuffled batches timed per repeat (default: 50).")
+parser.add_argument('--repeats', type=int, default=3,
+                    help="Number of timing repeats, the best one is reported (default: 3).")
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    for dataset in args.datasets:
+        dta_dataset = DTAPairDataset(root='data', dataset=dataset)
+        train_dataset, _, _ = dta_dataset.split()
+
+        pyg_batch = next(iter(DataLoader(train_dataset, batch_size=args.batch_size)))
+        batch = next(iter(PairBatchLoader(train_dataset, batch_size=args.batch_size)))
+        for key in pyg_batch.keys():
+            assert torch.equal(pyg_batch[key], batch[key]), f"Batches disagree on {key}!"
+
+        old = time_loader(DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True), args.num_batches, args.repeats)
+        new = time_loader(PairBatchLoader(train_dataset, batch_size=args.batch_size, shuffle=True), args.num_batches, args.repeats)
+        print(f"{dataset}: batch size {args.batch_size}, PyG collate {old * 1e3:.2f} ms/batch, "
+              f"vectorized {new * 1e3:.2f} ms/batch, speedup {old / new:.1f}x")
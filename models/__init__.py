@@ -0,0 +1,33 @@
+from models.gat import GATNet
+from models.gat_gcn import GAT_GCN
+from models.gcn import GCNNet
+from models.ginconv import GINConvNet
+
+from models.pdc_ginconv import PDC_GINConvNet
+from models.vnoc_ginconv import Vnoc_GINConvNet
+from models.pdc_vnoc_ginconv import PDC_Vnoc_GINConvNet
+from models.esm_ginconv import ESM_GINConvNet
+from models.fri_ginconv import FRI_GINConvNet
+
+from models.esm_gat import ESM_GATNet
+
+# Models selectable by name in the training scripts and benchmarks
+all_models = {
+    'GINConvNet': GINConvNet,
+    'GATNet': GATNet,
+    'GAT_GCN': GAT_GCN,
+    'GCNNet': GCNNet,
+    'PDC_GINConvNet': PDC_GINConvNet,
+    'Vnoc_GINConvNet': Vnoc_GINConvNet,
+    'ESM_GINConvNet': ESM_GINConvNet,
+    'FRI_GINConvNet': FRI_GINConvNet,
+    'PDC_Vnoc_GINConvNet': PDC_Vnoc_GINConvNet,
+    'ESM_GATNet': ESM_GATNet
+}
+
+# Protein encodings each model takes (DTAPairDataset target_type); the others take sequences
+model_target_types = {
+    'ESM_GINConvNet': 'esm',
+    'ESM_GATNet': 'esm',
+    'FRI_GINConvNet': 'deepfri',
+}
@@ -0,0 +1,112 @@
+import torch
+
+from utils import concat_ranges
+
+# Protein lookup table, shared by all models: batches carry `prot_idx` instead of per-sample targets
+def set_protein_table(model, table):
+    """Keeps one row per protein on the model's device; not saved in the state dict."""
+    if table.dtype == torch.uint8:
+        table = table.long()
+    model.register_buffer('protein_table', table, persistent=False)
+    return model
+
+def protein_targets(model, data, unique=False):
+    """Target rows of a batch, gathered from the model's protein table by `data.prot_idx` if the batch has one.
+
+    Unique-protein batches hold every protein once, plus `prot_inverse`, the protein of each
+    pair. With `unique` the rows are returned as they are, together with prot_inverse (None
+    for per-pair batches), so the protein branch runs once per protein and pair_proteins
+    gathers its output back to pairs; otherwise they are gathered to one row per pair.
+    Batches with a `target_len` (see batching.PairBatchLoader) hold sequence targets cut to
+    that length, which only models with `variable_length_targets` take.
+    """
+    protein_table = getattr(model, 'protein_table', None)
+    if protein_table is not None and 'prot_idx' in data:
+        target = protein_table[data.prot_idx, :data.target_len] if 'target_len' in data else protein_table[data.prot_idx]
+    else:
+        target = data.target
+    prot_inverse = data.prot_inverse if 'prot_inverse' in data else None
+    if unique:
+        return target, prot_inverse
+    return pair_proteins(target, prot_inverse)
+
+def pair_proteins(xt, prot_inverse):
+    """Protein rows, one per pair."""
+    if prot_inverse is None:
+        return xt
+    return xt[prot_inverse]
+
+def pair_weight(inverse):
+    """Number of pairs each row of a unique-drug/protein batch stands for (None for per-pair rows)."""
+    if inverse is None:
+        return None
+    return torch.bincount(inverse)
+
+# Unique-drug batches: every drug graph once, plus `drug_inverse`, the drug graph of each pair
+def drug_graphs(data, per_pair=False):
+    """x, edge_index, batch and drug_inverse of a batch's drug graphs.
+
+    For unique-drug batches the drug encoder runs once per graph and pair_drugs scatters
+    the pooled embeddings back to pairs. With `per_pair` (encoders with node-level dropout,
+    whose copies of a drug differ while training) the graphs are expanded back to one per
+    pair first. drug_inverse is None when every pair has its own graph.
+    """
+    if 'drug_inverse' not in data:
+        return data.x, data.edge_index, data.batch, None
+    if not per_pair:
+        return data.x, data.edge_index, data.batch, data.drug_inverse
+
+    inverse, ptr = data.drug_inverse, data.ptr
+    num_nodes = (ptr[1:] - ptr[:-1])[inverse]
+    num_edges = torch.bincount(data.batch[data.edge_index[0]], minlength=ptr.numel() - 1)
+    edge_ptr = torch.cat((num_edges.new_zeros(1), num_edges.cumsum(0)))
+    num_edges = num_edges[inverse]
+    pair_ptr = torch.cat((num_nodes.new_zeros(1), num_nodes.cumsum(0)))
+
+    x = data.x[concat_ranges(ptr[inverse], num_nodes)]
+    shift = torch.repeat_interleave(pair_ptr[:-1] - ptr[inverse], num_edges, output_size=int(num_edges.sum()))
+    edge_index = data.edge_index[:, concat_ranges(edge_ptr[inverse], num_edges)] + shift
+    batch = torch.repeat_interleave(torch.arange(inverse.numel(), device=x.device), num_nodes, output_size=x.size(0))
+    return x, edge_index, batch, None
+
+def drug_node_weight(batch, drug_inverse):
+    """Number of pairs each node stands for in a unique-drug batch (None for per-pair graphs)."""
+    if drug_inverse is None:
+        return None
+    return pair_weight(drug_inverse)[batch]
+
+def pair_drugs(x, drug_inverse):
+    """Pooled drug embeddings, one row per pair."""
+    if drug_inverse is None:
+        return x
+    return x[drug_inverse]
+
+def batch_norm(bn, x, weight=None):
+    """bn(x), with the rows of x counted `weight` times in the batch statistics.
+
+    Gives the outputs, gradients and running statistics of bn over the batch in which
+    every row (node, or protein of a [N, C(, L)] input) is repeated `weight` times.
+    Statistics are computed in at least float32, so half precision inputs under autocast
+    do not make the running statistics drift; the output keeps the dtype of x.
+    """
+    if weight is None or not (bn.training or not bn.track_running_stats):
+        return bn(x)
+
+    dims = [0] + list(range(2, x.dim()))
+    shape = [1, -1] + [1] * (x.dim() - 2)
+    dtype = x.dtype
+    x = x.to(torch.promote_types(dtype, torch.float32))
+    weight = weight.to(x.dtype).view(-1, *([1] * (x.dim() - 1)))
+    n = weight.sum() * x[0, 0].numel()
+    mean = (weight * x).sum(dims) / n
+    var = (weight * (x - mean.view(shape)) ** 2).sum(dims) / n
+    if bn.training and bn.track_running_stats:
+        with torch.no_grad():
+            bn.num_batches_tracked.add_(1)
+            momentum = bn.momentum if bn.momentum is not None else 1.0 / float(bn.num_batches_tracked)
+            bn.running_mean.mul_(1 - momentum).add_(momentum * mean)
+            bn.running_var.mul_(1 - momentum).add_(momentum * var * n / (n - 1))
+    x = (x - mean.view(shape)) / torch.sqrt(var.view(shape) + bn.eps)
+    if bn.affine:
+        x = x * bn.weight.view(shape) + bn.bias.view(shape)
+    return x.to(dtype)
@@ -5,6 +5,7 @@ from torch.nn import Sequential, Linear, ReLU
 from torch_geometric.nn import GATConv, AttentionalAggregation, GlobalAttention
 from torch_geometric.nn import global_max_pool as gmp
 from torch_scatter import scatter_add
+from models.common import protein_targets, pair_proteins, drug_graphs, pair_drugs
 
 
 class DGL_WeightAndSum(nn.Module):
@@ -62,8 +63,9 @@ class ESM_GATNet(torch.nn.Module):
 
     def forward(self, data):
         # graph input feed-forward
-        x, edge_index, batch = data.x, data.edge_index, data.batch
-        target = data.target
+        # node and attention dropout differ between copies of a drug, so graphs are per pair while training
+        x, edge_index, batch, drug_inverse = drug_graphs(data, per_pair=self.training)
+        target, prot_inverse = protein_targets(self, data, unique=True)
 
         x = F.dropout(x, p=0.2, training=self.training)
         x = F.elu(self.gcn1(x, edge_index))
@@ -72,6 +74,7 @@ class ESM_GATNet(torch.nn.Module):
         x = self.relu(x)
 
         x = self.readout(x, batch)          # weighted sum & max pooling
+        x = pair_drugs(x, drug_inverse)
 
         # x_sum = self.attention(x, batch)
         # x_max = gmp(x, batch)
@@ -79,6 +82,7 @@ class ESM_GATNet(torch.nn.Module):
 
         # ESM Protein embedding linear layer learning
         xt = self.fc_xt(target)
+        xt = pair_proteins(xt, prot_inverse)
 
         # concat
         xc = torch.cat((x, xt), 1)
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from torch.nn import Sequential, Linear, ReLU
 from torch_geometric.nn import GATConv
 from torch_geometric.nn import global_max_pool as gmp
+from models.common import protein_targets, pair_proteins, drug_graphs, pair_drugs
 
 # GAT  model
 class GATNet(torch.nn.Module):
@@ -32,7 +33,8 @@ class GATNet(torch.nn.Module):
 
     def forward(self, data):
         # graph input feed-forward
-        x, edge_index, batch = data.x, data.edge_index, data.batch
+        # node and attention dropout differ between copies of a drug, so graphs are per pair while training
+        x, edge_index, batch, drug_inverse = drug_graphs(data, per_pair=self.training)
 
         x = F.dropout(x, p=0.2, training=self.training)
         x = F.elu(self.gcn1(x, edge_index))
@@ -40,11 +42,12 @@ class GATNet(torch.nn.Module):
         x = self.gcn2(x, edge_index)
         x = self.relu(x)
         x = gmp(x, batch)          # global max pooling
+        x = pair_drugs(x, drug_inverse)
         x = self.fc_g1(x)
         x = self.relu(x)
 
         # protein input feed-forward:
-        target = data.target
+        target, prot_inverse = protein_targets(self, data, unique=True)
         embedded_xt = self.embedding_xt(target)
         conv_xt = self.conv_xt1(embedded_xt)
         conv_xt = self.relu(conv_xt)
@@ -52,6 +55,7 @@ class GATNet(torch.nn.Module):
         # flatten
         xt = conv_xt.view(-1, 32 * 121)
         xt = self.fc_xt1(xt)
+        xt = pair_proteins(xt, prot_inverse)
 
         # concat
         xc = torch.cat((x, xt), 1)
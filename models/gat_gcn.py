@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from torch.nn import Sequential, Linear, ReLU
 from torch_geometric.nn import GCNConv, GATConv, GINConv, global_add_pool
 from torch_geometric.nn import global_mean_pool as gap, global_max_pool as gmp
+from models.common import protein_targets, pair_proteins, drug_graphs, pair_drugs
 
 # GCN-CNN based model
 
@@ -32,8 +33,8 @@ class GAT_GCN(torch.nn.Module):
         self.out = nn.Linear(512, self.n_output)        # n_output = 1 for regression task
 
     def forward(self, data):
-        x, edge_index, batch = data.x, data.edge_index, data.batch
-        target = data.target
+        x, edge_index, batch, drug_inverse = drug_graphs(data)
+        target, prot_inverse = protein_targets(self, data, unique=True)
         # print('x shape = ', x.shape)
         x = self.conv1(x, edge_index)
         x = self.relu(x)
@@ -41,6 +42,7 @@ class GAT_GCN(torch.nn.Module):
         x = self.relu(x)
         # apply global max pooling (gmp) and global mean pooling (gap)
         x = torch.cat([gmp(x, batch), gap(x, batch)], dim=1)
+        x = pair_drugs(x, drug_inverse)
         x = self.relu(self.fc_g1(x))
         x = self.dropout(x)
         x = self.fc_g2(x)
@@ -50,6 +52,7 @@ class GAT_GCN(torch.nn.Module):
         # flatten
         xt = conv_xt.view(-1, 32 * 121)
         xt = self.fc1_xt(xt)
+        xt = pair_proteins(xt, prot_inverse)
 
         # concat
         xc = torch.cat((x, xt), 1)
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch_geometric.nn import GCNConv, global_max_pool as gmp
+from models.common import protein_targets, pair_proteins, drug_graphs, pair_drugs
 
 
 # GCN based model
@@ -32,9 +33,9 @@ class GCNNet(torch.nn.Module):
 
     def forward(self, data):
         # get graph input
-        x, edge_index, batch = data.x, data.edge_index, data.batch
+        x, edge_index, batch, drug_inverse = drug_graphs(data)
         # get protein input
-        target = data.target
+        target, prot_inverse = protein_targets(self, data, unique=True)
 
         x = self.conv1(x, edge_index)
         x = self.relu(x)
@@ -45,6 +46,7 @@ class GCNNet(torch.nn.Module):
         x = self.conv3(x, edge_index)
         x = self.relu(x)
         x = gmp(x, batch)       # global max pooling
+        x = pair_drugs(x, drug_inverse)
 
         # flatten
         x = self.relu(self.fc_g1(x))
@@ -58,6 +60,7 @@ class GCNNet(torch.nn.Module):
         # flatten
         xt = conv_xt.view(-1, 32 * 121)
         xt = self.fc1_xt(xt)
+        xt = pair_proteins(xt, prot_inverse)
 
         # concat
         xc = torch.cat((x, xt), 1)
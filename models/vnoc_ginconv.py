@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from torch.nn import Sequential, Linear, ReLU
 from torch_geometric.nn import GINConv, global_add_pool
 from torch_geometric.nn import global_mean_pool as gap, global_max_pool as gmp
+from models.common import protein_targets, pair_proteins, pair_weight, drug_graphs, drug_node_weight, pair_drugs, batch_norm
 
 class GlobalMaxPooling1D(nn.Module):
     def __init(self):
@@ -14,6 +15,11 @@ class GlobalMaxPooling1D(nn.Module):
 
 # GINConv model + transposed Conv1D input
 class Vnoc_GINConvNet(torch.nn.Module):
+    # The protein convolutions run along the sequence and are max-pooled, so they accept shorter (truncated) targets.
+    # Outputs are not those of full-length targets: the batch norm statistics and the max-pooled windows
+    # over the padding change, so truncated runs are not comparable to full-length checkpoints
+    variable_length_targets = True
+
     def __init__(self, n_output=1,num_features_xd=78, num_features_xt=25,
                  n_filters=32, embed_dim=128, output_dim=128, dropout=0.2, num_layers=3, kernel_size=16):
 
@@ -84,20 +90,23 @@ class Vnoc_GINConvNet(torch.nn.Module):
         self.out = nn.Linear(256, self.n_output)        # n_output = 1 for regression task
 
     def forward(self, data):
-        x, edge_index, batch = data.x, data.edge_index, data.batch
-        target = data.target
+        x, edge_index, batch, drug_inverse = drug_graphs(data)
+        node_weight = drug_node_weight(batch, drug_inverse)
+        target, prot_inverse = protein_targets(self, data, unique=True)
+        protein_weight = pair_weight(prot_inverse)
 
         x = F.relu(self.conv1(x, edge_index))
-        x = self.bn1(x)
+        x = batch_norm(self.bn1, x, node_weight)
         x = F.relu(self.conv2(x, edge_index))
-        x = self.bn2(x)
+        x = batch_norm(self.bn2, x, node_weight)
         x = F.relu(self.conv3(x, edge_index))
-        x = self.bn3(x)
+        x = batch_norm(self.bn3, x, node_weight)
         x = F.relu(self.conv4(x, edge_index))
-        x = self.bn4(x)
+        x = batch_norm(self.bn4, x, node_weight)
         x = F.relu(self.conv5(x, edge_index))
-        x = self.bn5(x)
+        x = batch_norm(self.bn5, x, node_weight)
         x = global_add_pool(x, batch)
+        x = pair_drugs(x, drug_inverse)
         x = F.relu(self.fc1_xd(x))
         x = F.dropout(x, p=0.2, training=self.training)
 
@@ -106,29 +115,29 @@ class Vnoc_GINConvNet(torch.nn.Module):
 
         if self.num_layers == 1:
             conv_xt = self.conv_xt_1(embedded_xt)
-            conv_xt = self.bn_xt1(conv_xt)
+            conv_xt = batch_norm(self.bn_xt1, conv_xt, protein_weight)
             conv_xt = self.relu(conv_xt)
 
         elif self.num_layers == 2:
             conv_xt = self.conv_xt_1(embedded_xt)
-            conv_xt = self.bn_xt1(conv_xt)
+            conv_xt = batch_norm(self.bn_xt1, conv_xt, protein_weight)
             conv_xt = self.relu(conv_xt)
 
             conv_xt = self.conv_xt_2(conv_xt)
-            conv_xt = self.bn_xt2(conv_xt)
+            conv_xt = batch_norm(self.bn_xt2, conv_xt, protein_weight)
             conv_xt = self.relu(conv_xt)
 
         elif self.num_layers == 3:
             conv_xt = self.conv_xt_1(embedded_xt)
-            conv_xt = self.bn_xt1(conv_xt)
+            conv_xt = batch_norm(self.bn_xt1, conv_xt, protein_weight)
             conv_xt = self.relu(conv_xt)
 
             conv_xt = self.conv_xt_2(conv_xt)
-            conv_xt = self.bn_xt2(conv_xt)
+            conv_xt = batch_norm(self.bn_xt2, conv_xt, protein_weight)
             conv_xt = self.relu(conv_xt)
 
             conv_xt = self.conv_xt_3(conv_xt)
-            conv_xt = self.bn_xt3(conv_xt)
+            conv_xt = batch_norm(self.bn_xt3, conv_xt, protein_weight)
             conv_xt = self.relu(conv_xt)
 
         xt = self.gmp_xt(conv_xt)
@@ -138,8 +147,9 @@ class Vnoc_GINConvNet(torch.nn.Module):
 
         # linear
         xt = self.fc1_xt(xt)
-        xt = self.bn_fc1(xt)
+        xt = batch_norm(self.bn_fc1, xt, protein_weight)
         xt = self.relu(xt)
+        xt = pair_proteins(xt, prot_inverse)
 
         # concat
         xc = torch.cat((x, xt), 1)
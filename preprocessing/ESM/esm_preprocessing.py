@@ -3,7 +3,6 @@ import pandas as pd
 import numpy as np
 import esm
 from rdkit import Chem
-import networkx as nx
 from utils import *
 import argparse
 from tqdm import tqdm
@@ -18,9 +17,9 @@ batch_converter = alphabet.get_batch_converter()
 datasets = ['davis', 'kiba']
 for dataset in datasets:
     embeddings = []
-    processed_dataset = 'data/' + dataset + '/proteins_esm.json'
+    processed_dataset = 'data/' + dataset + '/proteins_esm'
 
-    if not os.path.isfile(processed_dataset):
+    if not os.path.isfile(processed_dataset + '.npy'):
         proteins = json.load(open('data/' + dataset + "/proteins.json"), object_pairs_hook=OrderedDict)
         prots = []
         protein_keys = []
@@ -55,13 +54,8 @@ for dataset in datasets:
 
         embeddings = np.asarray(embeddings)
 
-        df = pd.DataFrame({
-            'protein_key': protein_keys,
-            'sequence': prots,
-            'embedding': [emb.tolist() for emb in embeddings]
-        })
-        df.to_json(processed_dataset, orient='records', indent=4)
+        save_embedding_store(processed_dataset, protein_keys, embeddings)
 
-        print(processed_dataset, ' has been created')
+        print(processed_dataset + '.npy', ' has been created')
     else:
-        print(processed_dataset, ' is already created')
\ No newline at end of file
+        print(processed_dataset + '.npy', ' is already created')
\ No newline at end of file
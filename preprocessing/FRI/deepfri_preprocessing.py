@@ -9,6 +9,7 @@ tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
 import json
 from .deepfrier.Predictor import Predictor
+from utils import save_embedding_store
 import pandas as pd
 import numpy as np
 import argparse
@@ -30,8 +31,8 @@ predictor = Predictor(models[ont], gcn = gcn)
 datasets = ['davis', 'kiba']
 for dataset in datasets:
     embeddings = []
-    processed_dataset = 'data/' + dataset + '/proteins_deepfri.json'
-    if not os.path.isfile(processed_dataset):
+    processed_dataset = 'data/' + dataset + '/proteins_deepfri'
+    if not os.path.isfile(processed_dataset + '.npy'):
 
         predictor = Predictor(models[ont], gcn=gcn)
         
@@ -50,13 +51,8 @@ for dataset in datasets:
 
         embeddings = np.asarray(embeddings)
 
-        df = pd.DataFrame({
-            'protein_key': protein_keys,
-            'sequence': prots,
-            'embedding': [emb.tolist() for emb in embeddings]
-        })
-        df.to_json(processed_dataset, orient='records', indent=4)
+        save_embedding_store(processed_dataset, protein_keys, embeddings)
 
-        print(processed_dataset, ' has been created')
+        print(processed_dataset + '.npy', ' has been created')
     else:
-        print(processed_dataset, ' is already created')
\ No newline at end of file
+        print(processed_dataset + '.npy', ' is already created')
\ No newline at end of file
@@ -9,7 +9,7 @@ seed=(0 1 2 3 4)
 for dataset in "${datasets[@]}"; do
     for model in "${models[@]}"; do
         for s in "${seed[@]}"; do
-            python training.py --seed "$s" --wandb --dataset "$dataset" --model "$model" &
+            python training.py --seed "$s" --wandb --mmap --dataset "$dataset" --model "$model" &
         done
         wait
     done
@@ -17,7 +17,7 @@ done
 
 for model in "${models[@]}"; do
     for s in "${seed[@]}"; do
-        python training.py --seed "$s" --wandb --dataset "davis" --model "$model" --mutation &
+        python training.py --seed "$s" --wandb --mmap --dataset "davis" --model "$model" --mutation &
     done
     wait
 done
\ No newline at end of file
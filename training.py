@@ -1,105 +1,135 @@
 import numpy as np
 import pandas as pd
 import os
+import copy
 import torch
 import torch.nn as nn
 
-from models.gat import GATNet
-from models.gat_gcn import GAT_GCN
-from models.gcn import GCNNet
-from models.ginconv import GINConvNet
-
-from models.pdc_ginconv import PDC_GINConvNet
-from models.vnoc_ginconv import Vnoc_GINConvNet
-from models.pdc_vnoc_ginconv import PDC_Vnoc_GINConvNet
-from models.esm_ginconv import ESM_GINConvNet
-from models.fri_ginconv import FRI_GINConvNet
-
-from models.esm_gat import ESM_GATNet
+from models import all_models, model_target_types
+from models.common import set_protein_table
 
 import wandb
 import random
 from utils import *
+from batching import PairBatchLoader, DevicePrefetcher
 import argparse
 from tqdm import tqdm
 
 # training function at each epoch
-def train(model, device, train_loader, optimizer, epoch, wandb_log=False):
+def train(model, device, train_loader, optimizer, epoch, wandb_log=False, amp_dtype=None, scaler=None):
     # print('Training on {} samples...'.format(len(train_loader.dataset)))
     model.train()
+    epoch_loss = torch.zeros((), device=device)
     for batch_idx, data in tqdm(enumerate(train_loader), total=len(train_loader), leave=False, desc=f"Epoch {epoch}"):
-        data = data.to(device)
+        data = expand_compact(data.to(device))
         optimizer.zero_grad()
-        output = model(data)
-        loss = loss_fn(output, data.y.view(-1, 1).float().to(device))
-        loss.backward()
-        optimizer.step()
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            output = model(data)
+        loss = loss_fn(output.float(), data.y.view(-1, 1).float().to(device))
+        if scaler is None:
+            loss.backward()
+            optimizer.step()
+        else:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        epoch_loss += loss.detach()
         # if batch_idx % LOG_INTERVAL == 0:
             # print('Train epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(epoch,
             #                                                                batch_idx * len(data.x),
             #                                                                len(train_loader.dataset),
             #                                                                100. * batch_idx / len(train_loader),
             #                                                                loss.item()))
-    tqdm.write('Train loss: {:.6f}'.format(loss.item()))
+    epoch_loss = epoch_loss.item() / len(train_loader)
+    tqdm.write('Train loss: {:.6f}, epoch mean: {:.6f}, data wait: {:.2f}s'.format(loss.item(), epoch_loss, train_loader.wait_time))
     if wandb_log:
-        wandb.log({"loss": loss.item()})
-    return loss.item()
+        wandb.log({"loss": loss.item(), "epoch_loss": epoch_loss, "data_wait": train_loader.wait_time})
+    return epoch_loss
 
-def predicting(model, device, loader):
+def predicting(model, device, loader, amp_dtype=None):
     model.eval()
     total_preds = torch.Tensor()
     total_labels = torch.Tensor()
     # print('Make prediction for {} samples...'.format(len(loader.dataset)))
     with torch.no_grad():
         for data in tqdm(loader, total=len(loader), leave=False, desc="Predicting"):
-            data = data.to(device)
-            output = model(data)
-            total_preds = torch.cat((total_preds, output.cpu()), 0)
+            data = expand_compact(data.to(device))
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                output = model(data)
+            total_preds = torch.cat((total_preds, output.float().cpu()), 0)
             total_labels = torch.cat((total_labels, data.y.view(-1, 1).cpu()), 0)
     return total_labels.numpy().flatten(),total_preds.numpy().flatten()
 
-datasets = ['davis', 'kiba']
-
-all_models = {
-    'GINConvNet': GINConvNet, 
-    'GATNet': GATNet, 
-    'GAT_GCN': GAT_GCN, 
-    'GCNNet': GCNNet, 
-    'PDC_GINConvNet': PDC_GINConvNet, 
-    'Vnoc_GINConvNet': Vnoc_GINConvNet, 
-    'ESM_GINConvNet': ESM_GINConvNet, 
-    'FRI_GINConvNet': FRI_GINConvNet, 
-    'PDC_Vnoc_GINConvNet': PDC_Vnoc_GINConvNet,
-    'ESM_GATNet': ESM_GATNet
-}
-
 parser = argparse.ArgumentParser(description="Run a specific model on a specific dataset.")
 
-parser.add_argument('--dataset', type=str, choices=datasets, required=True, 
-                    help="Dataset name: 'davis' or 'kiba'.")
+parser.add_argument('--dataset', type=str, required=True,
+                    help="Dataset name: 'davis', 'kiba', or any other directory under data/, e.g. one with an affinities.csv.")
+parser.add_argument('--affinity_unit', type=str, default='pkd', choices=AFFINITY_UNITS,
+                    help="Unit of the affinity column of an affinities.csv dataset: 'pkd' is used as is, 'kd' (Kd in nM) is "
+                         "converted to -log10(Kd/1e9) (default: pkd).")
 parser.add_argument('--model', type=str, choices=list(all_models.keys()), required=True, 
                     help="Model name. Choose from: " + ", ".join(all_models.keys()) + ".")
 parser.add_argument('--cuda', type=int, default=0, 
                     help="CUDA device index (default: 0).")
 parser.add_argument('--seed', type=int, default=None, 
                     help="Random seed for reproducibility (default: None).")
+parser.add_argument('--seeds', type=str, default=None,
+                    help="Comma-separated random seeds, e.g. 0,1,2,3,4, of replicas trained one after another in this process, overriding --seed. "
+                         "The replicas share the loaded dataset, splits and caches but do not run in parallel, so this is no faster "
+                         "than separate --seed runs; the run_*.sh scripts start those concurrently, with --mmap (default: None).")
 parser.add_argument('--wandb', action='store_true', default=False,
                     help="Flag for using wandb logging (default: False).")
 parser.add_argument('--mutation', action='store_true', default=False,
                     help="Flag for including protein sequence mutations for the Davis dataset (default: False).")
 parser.add_argument('--num_layers', type=int, default=3,
                     help="Number of layers in the protein learning channel (default: 3).")
+parser.add_argument('--num_workers', type=int, default=0,
+                    help="Number of worker processes for drug featurization when building the processed dataset (default: 0).")
+parser.add_argument('--mmap', action='store_true', default=False,
+                    help="Flag for memory-mapping the processed dataset, shared by concurrently running seeds (default: False).")
+parser.add_argument('--compact', action='store_true', default=False,
+                    help="Flag for keeping drug atoms and protein sequences as uint8 codes until they are on the device (default: False).")
+parser.add_argument('--protein_table', action='store_true', default=False,
+                    help="Flag for keeping the protein targets once on the device and batching protein indices only (default: False).")
+parser.add_argument('--dedup_drugs', action='store_true', default=False,
+                    help="Flag for running the drug encoder once per distinct drug in a batch (default: False).")
+parser.add_argument('--dedup_proteins', action='store_true', default=False,
+                    help="Flag for running the protein branch once per distinct protein in a batch (default: False).")
+parser.add_argument('--loader_workers', type=int, default=0,
+                    help="Number of background worker processes collating batches (default: 0).")
+parser.add_argument('--prefetch', type=int, default=2,
+                    help="Number of batches collated and transferred to the device ahead of the current one (default: 2).")
+parser.add_argument('--resident', action='store_true', default=False,
+                    help="Flag for keeping the whole dataset on the device and gathering batches there; disables loader workers (default: False).")
+parser.add_argument('--buckets', type=int, default=0,
+                    help="Number of protein length and of drug size quantiles pairs are bucketed by before batching, 0 for uniform batches (default: 0).")
+parser.add_argument('--truncate_padding', action='store_true', default=False,
+                    help="Flag for cutting sequence targets after the longest protein of each batch, for Vnoc models. This changes the "
+                         "model outputs (batch norm statistics and pooling over the padding), so results are not comparable "
+                         "to full-length runs or checkpoints (default: False).")
+parser.add_argument('--amp', type=str, default=None, choices=['bf16', 'fp16'],
+                    help="Mixed precision autocast type, fp16 with loss scaling on CUDA only (default: None, fp32).")
+parser.add_argument('--compile', action='store_true', default=False,
+                    help="Flag for running the model through torch.compile, eagerly where it does not compile (default: False).")
+parser.add_argument('--epochs', type=int, default=1000,
+                    help="Maximum number of training epochs. The weights of the epoch with the lowest epoch-mean training loss are restored "
+                         "at the end, and are the ones saved and tested, instead of the final weights (default: 1000).")
+parser.add_argument('--patience', type=int, default=0,
+                    help="Number of epochs without improvement of the monitored metric before training stops, 0 to never stop early (default: 0).")
+parser.add_argument('--min_delta', type=float, default=0.0,
+                    help="Smallest change of the monitored metric counted as an improvement (default: 0.0).")
+parser.add_argument('--lr_patience', type=int, default=0,
+                    help="Number of epochs without improvement before the learning rate is reduced, 0 to keep it constant (default: 0).")
+parser.add_argument('--lr_factor', type=float, default=0.5,
+                    help="Factor the learning rate is reduced by on a plateau (default: 0.5).")
 args = parser.parse_args()
+if args.epochs < 1:
+    parser.error("--epochs must be at least 1.")
 
 modeling = all_models[args.model]
 model_st = modeling.__name__
 
-if model_st in ["ESM_GINConvNet", "ESM_GATNet"]:
-    target_type = 'esm'
-elif model_st == "FRI_GINConvNet":
-    target_type = 'deepfri'
-else:
-    target_type = None
+target_type = model_target_types.get(model_st)
 
 dataset = args.dataset
 # split_type = args.split_type
@@ -108,19 +138,8 @@ dataset = args.dataset
 cuda_name = f"cuda:{args.cuda}"
 print('cuda_name:', cuda_name)
 
-# Set seed:
-if args.seed is not None:
-    seed = args.seed
-    print("Seed: " + str(seed))
-    os.environ["CUBLAS_WORKSPACE_CONFIG"]=":4096:8"
-    random.seed(seed)
-    np.random.seed(seed)
-    torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
-    torch.use_deterministic_algorithms(True)
+# Seeds of the replicas to train, each seeded (see seed_everything) before it starts
+seeds = [int(seed) for seed in args.seeds.split(',')] if args.seeds else [args.seed]
 
 # torch.backends.cudnn.benchmark = True
 # torch.backends.cudnn.deterministic = False
@@ -129,87 +148,122 @@ TRAIN_BATCH_SIZE = 512
 TEST_BATCH_SIZE = 512
 LR = 0.0005
 LOG_INTERVAL = 20
-NUM_EPOCHS = 1000
+NUM_EPOCHS = args.epochs
 
 print('Learning rate: ', LR)
 print('Epochs: ', NUM_EPOCHS)
 
 group_name = f"{args.model}_{args.dataset}_{args.num_layers}_layers"
-run_name = f"{args.model}_{args.dataset}_{args.num_layers}_layers"
 if args.mutation:
     group_name += "_mutation"
-    run_name += "_mutation"
-if args.seed is not None:
-    run_name += f"_seed_{args.seed}"
-run_name += f"_testing"
-
-if args.wandb:
-    wandb.init(project = 'E-GraphDTA - Testing', config = args, group = group_name, name = run_name )
-    
+
+def replica_run_name(seed):
+    run_name = group_name
+    if seed is not None:
+        run_name += f"_seed_{seed}"
+    run_name += f"_testing"
+    return run_name
+
 # Main program: Train on specified dataset 
 if __name__ == "__main__":
     print('Training ' + model_st + ' on ' + dataset + ' dataset...')
-    dta_dataset = DTADataset(root='data', dataset=dataset, target_type=target_type, mutation=args.mutation)
+    dta_dataset = DTAPairDataset(root='data', dataset=dataset, target_type=target_type, mutation=args.mutation, num_workers=args.num_workers, mmap=args.mmap,
+                                 compact=args.compact, protein_lookup=args.protein_table, affinity_unit=args.affinity_unit)
+    device = torch.device(cuda_name if torch.cuda.is_available() else "cpu")
+    if args.resident:
+        dta_dataset.to(device)
 
     # Train on all data except the test set (fold == -1)
-    train_folds = [0, 1, 2, 3, 4]
-    
-    train_mask = torch.isin(dta_dataset._data.fold, torch.tensor(train_folds))
-    train_dataset = dta_dataset[train_mask]
-    test_dataset = dta_dataset[dta_dataset._data.fold == -1]
+    train_dataset, _, test_dataset = dta_dataset.split()
 
     # make data PyTorch mini-batch processing ready
-    train_loader = DataLoader(train_dataset, batch_size=TRAIN_BATCH_SIZE, shuffle=True)
-    test_loader = DataLoader(test_dataset, batch_size=TEST_BATCH_SIZE, shuffle=False)
-
-    # training the model
-    device = torch.device(cuda_name if torch.cuda.is_available() else "cpu")
-    model = modeling(num_layers=args.num_layers).to(device)
-    loss_fn = nn.MSELoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=LR)
-
-    best_loss = 1000
-    best_epoch = -1
-
-    for epoch in range(NUM_EPOCHS):
-        tqdm.write(f'\nEpoch {epoch+1}')
-        train_loss = train(model, device, train_loader, optimizer, epoch+1, wandb_log=args.wandb)
-
-        if train_loss < best_loss:
-            best_model = model
-            best_epoch = epoch+1
-            best_loss = train_loss
-        tqdm.write(f'Best loss: {best_loss:.6f} (epoch {best_epoch})')
-
-    model_file_name = 'trained_models/model_' + run_name + '_testing.model'
-    result_file_name = 'trained_models/result_' + run_name + '_testing.csv'
-    os.makedirs('trained_models', exist_ok=True)
-
-    torch.save(best_model.state_dict(), model_file_name)
-
-    G,P = predicting(best_model, device, test_loader)
-    test_ret = [rmse(G,P),mse(G,P),pearson(G,P),spearman(G,P),ci(G,P)]
-
-    tqdm.write('\nResults on test set:')
-    tqdm.write(f"RMSE: {test_ret[0]}")
-    tqdm.write(f"MSE: {test_ret[1]}")
-    tqdm.write(f"Pearson: {test_ret[2]}")
-    tqdm.write(f"Spearman: {test_ret[3]}")
-    tqdm.write(f"CI: {test_ret[4]}")
-
-    if args.wandb:
-        wandb.log({
-            "test_rmse": test_ret[0],
-            "test_mse": test_ret[1],
-            "test_pearson": test_ret[2],
-            "test_spearman": test_ret[3],
-            "test_ci": test_ret[4]
-        })
-        wandb.finish()
-
-    with open(result_file_name, 'w') as f:
-        # write header
-        f.write("test_rmse,test_mse,test_pearson,test_spearman,test_ci\n")
-        # write values
-        f.write(','.join(map(str, test_ret)))
+    loader_args = dict(dedup_drugs=args.dedup_drugs, dedup_proteins=args.dedup_proteins, num_workers=0 if args.resident else args.loader_workers,
+                       pin_memory=device.type == 'cuda' and not args.resident, prefetch_factor=args.prefetch, buckets=args.buckets,
+                       truncate_targets=args.truncate_padding and getattr(modeling, 'variable_length_targets', False))
+    if args.truncate_padding and not getattr(modeling, 'variable_length_targets', False):
+        print(f'{model_st} takes fixed-length protein targets, ignoring --truncate_padding')
+    train_loader = DevicePrefetcher(PairBatchLoader(train_dataset, batch_size=TRAIN_BATCH_SIZE, shuffle=True, **loader_args),
+                                    device, depth=args.prefetch)
+    test_loader = DevicePrefetcher(PairBatchLoader(test_dataset, batch_size=TEST_BATCH_SIZE, shuffle=False, **loader_args),
+                                   device, depth=args.prefetch)
+
+    for seed in seeds:
+        if seed is not None:
+            seed_everything(seed)
+        run_name = replica_run_name(seed)
+        if args.wandb:
+            wandb.init(project = 'E-GraphDTA - Testing', config = {**vars(args), 'seed': seed}, group = group_name, name = run_name)
+
+        # training the model
+        model = modeling(num_layers=args.num_layers).to(device)
+        if args.protein_table:
+            set_protein_table(model, dta_dataset.target.to(device))
+        if args.compile:
+            model = compile_model(model)
+        loss_fn = nn.MSELoss()
+        optimizer = torch.optim.Adam(model.parameters(), lr=LR)
+        autocast_dtype = amp_dtype(args.amp, device)
+        scaler = torch.amp.GradScaler(device.type) if autocast_dtype == torch.float16 else None
+
+        stopper = EarlyStopping(patience=args.patience, min_delta=args.min_delta)
+        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=args.lr_factor, patience=args.lr_patience,
+                                                               threshold=args.min_delta, threshold_mode='abs') if args.lr_patience > 0 else None
+        best_epoch = -1
+        best_state = None
+
+        for epoch in range(NUM_EPOCHS):
+            tqdm.write(f'\nEpoch {epoch+1}')
+            train_loss = train(model, device, train_loader, optimizer, epoch+1, wandb_log=args.wandb,
+                               amp_dtype=autocast_dtype, scaler=scaler)
+
+            if stopper.step(train_loss):
+                best_state = copy.deepcopy(model.state_dict())
+                best_epoch = epoch+1
+            if stopper.best is not None:
+                tqdm.write(f'Best loss: {stopper.best:.6f} (epoch {best_epoch})')
+            if scheduler is not None:
+                scheduler.step(train_loss)
+            if stopper.stop:
+                tqdm.write(f'No improvement for {args.patience} epochs, stopping')
+                break
+        stop_epoch = epoch+1
+
+        # No epoch is best if every monitored value was NaN; the final weights are kept then
+        if best_state is not None:
+            model.load_state_dict(best_state)
+        best_model = model
+
+        model_file_name = 'trained_models/model_' + run_name + '_testing.model'
+        result_file_name = 'trained_models/result_' + run_name + '_testing.csv'
+        os.makedirs('trained_models', exist_ok=True)
+
+        # Compiled models keep the original module, and its parameter names, in _orig_mod
+        torch.save(getattr(best_model, '_orig_mod', best_model).state_dict(), model_file_name)
+
+        G,P = predicting(best_model, device, test_loader, amp_dtype=autocast_dtype)
+        test_ret = [rmse(G,P),mse(G,P),pearson(G,P),spearman(G,P),ci(G,P)]
+
+        tqdm.write('\nResults on test set:')
+        tqdm.write(f"RMSE: {test_ret[0]}")
+        tqdm.write(f"MSE: {test_ret[1]}")
+        tqdm.write(f"Pearson: {test_ret[2]}")
+        tqdm.write(f"Spearman: {test_ret[3]}")
+        tqdm.write(f"CI: {test_ret[4]}")
+
+        if args.wandb:
+            wandb.log({
+                "test_rmse": test_ret[0],
+                "test_mse": test_ret[1],
+                "test_pearson": test_ret[2],
+                "test_spearman": test_ret[3],
+                "test_ci": test_ret[4]
+            })
+            wandb.finish()
+
+        with open(result_file_name, 'w') as f:
+            # write header
+            f.write("test_rmse,test_mse,test_pearson,test_spearman,test_ci,best_epoch,stop_epoch\n")
+            # write values
+            f.write(','.join(map(str, test_ret)))
+            f.write(f',{best_epoch},{stop_epoch}')
     
\ No newline at end of file
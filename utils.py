@@ -2,20 +2,26 @@ import os
 import numpy as np
 from math import sqrt
 from scipy import stats
-from torch_geometric.data import InMemoryDataset
+from torch_geometric.data import InMemoryDataset, Dataset
 from torch_geometric.loader import DataLoader
 from torch_geometric import data as DATA
 import torch
 import pandas as pd
 from rdkit import Chem
-import networkx as nx
 from tqdm import tqdm
 import json
 import pickle
+import hashlib
+import shutil
 from collections import OrderedDict
+import copy
+import random
+from multiprocessing import Pool
+from functools import partial
 
 class DTADataset(InMemoryDataset):
-    def __init__(self, root: str = 'data', dataset: str = 'davis', target_type: str = None, mutation: bool = False): #, cluster_type: str = None):
+    def __init__(self, root: str = 'data', dataset: str = 'davis', target_type: str = None, mutation: bool = False, num_workers: int = 0, mmap: bool = False,
+                 compact: bool = False): #, cluster_type: str = None):
 
         self.root = root
         self.dataset = dataset
@@ -23,15 +29,26 @@ class DTADataset(InMemoryDataset):
 
         self.target_type = target_type
         self.mutation = mutation
+        self.num_workers = num_workers
+        # Memory-map the processed tensors instead of reading them into private memory,
+        # so concurrent runs on the same dataset share a single page-cache copy
+        self.mmap = mmap
+        # Store atoms as uint8 atom_feature_indices and sequences as uint8 codes, see expand_compact
+        self.compact = compact
 
         super().__init__(root, transform=None, pre_transform=None)
 
-        if os.path.isfile(self.processed_paths[0]):
+        manifest_path = os.path.splitext(self.processed_paths[0])[0] + '_manifest.json'
+        if os.path.isfile(self.processed_paths[0]) and load_manifest(manifest_path) == self.raw_manifest():
             print('Pre-processed data found: {}, loading ...'.format(self.processed_paths[0]))
         else:
-            print('Pre-processed data {} not found, doing pre-processing...'.format(self.processed_paths[0]))
+            if os.path.isfile(self.processed_paths[0]):
+                print('Raw data changed since {} was built, doing pre-processing...'.format(self.processed_paths[0]))
+            else:
+                print('Pre-processed data {} not found, doing pre-processing...'.format(self.processed_paths[0]))
             self.process()
-        self.data, self.slices = torch.load(self.processed_paths[0])
+            save_manifest(manifest_path, self.raw_manifest())
+        self.data, self.slices = torch.load(self.processed_paths[0], mmap=self.mmap)
 
     @property
     def raw_file_names(self):
@@ -46,9 +63,13 @@ class DTADataset(InMemoryDataset):
         processed_file_names = f"{self.dataset}"
         # processed_file_names += f"_{self.cluster_type}" if self.cluster_type else ""
         processed_file_names += f"_{self.target_type}" if self.target_type else ""
-        processed_file_names += f"_mutation.pt" if self.mutation else ".pt"
+        processed_file_names += f"_mutation" if self.mutation else ""
+        processed_file_names += f"_compact.pt" if self.compact else ".pt"
         return [processed_file_names]
 
+    def raw_manifest(self):
+        return raw_manifest(self.raw_file_names[0] + '/', self.dataset, self.target_type, self.mutation)
+
     def download(self):
         pass
 
@@ -60,146 +81,521 @@ class DTADataset(InMemoryDataset):
             os.makedirs(self.processed_dir)
 
     def process(self):
-        data_list = []
-
         fpath = self.raw_file_names[0] + '/'
 
-        # Load fold information
-        train_fold = json.load(open(fpath + "folds/train_fold_setting1.txt"))
-        test_fold = json.load(open(fpath + "folds/test_fold_setting1.txt"))
-
-        index_to_fold = {}
-        for fold_num, fold_indices in enumerate(train_fold):
-            for idx in fold_indices:
-                index_to_fold[idx] = fold_num
-        for idx in test_fold:
-            index_to_fold[idx] = -1
-
-        # Load ligands, proteins, protein encodings, and affinity data
-        ligands = json.load(open(fpath + "drugs.json"), object_pairs_hook=OrderedDict)
-        affinity = pickle.load(open(fpath + "Y","rb"), encoding='latin1')
-        if self.mutation and self.dataset == 'davis':
-            proteins = json.load(open(fpath + "proteins_mutation.json"), object_pairs_hook=OrderedDict)
-        else:
-            proteins = json.load(open(fpath + "proteins.json"), object_pairs_hook=OrderedDict)
+        # Load ligands, proteins, protein encodings, affinity data and fold information
+        store = DrugGraphStore(self.processed_dir, num_workers=self.num_workers)
+        drugs, prots, ligand_keys, protein_keys, protein_encodings, affinity, rows, cols, pair_folds = \
+            load_raw_data(fpath, self.dataset, self.target_type, self.mutation,
+                          canonical_smiles=store.canonical_smiles, store_dir=self.processed_dir)
+
+        # Graph data of every unique SMILES, from the shared drug graph store
+        unique_smiles = list(dict.fromkeys(drugs))
+        smiles_to_idx = {smile: i for i, smile in enumerate(unique_smiles)}
+        drug_x, drug_edge_index, drug_x_ptr, drug_edge_ptr = store.graphs(unique_smiles, compact=self.compact)
+        num_nodes = drug_x_ptr.diff()
+        num_edges = drug_edge_ptr.diff()
 
-        # Load precomputed protein embeddings
+        # Protein targets, one row per protein
         if self.target_type == 'deepfri' or self.target_type == 'esm':
-            if self.mutation and self.dataset == 'davis':
-                with open(fpath + f"proteins_{self.target_type}_mutation_.json", 'r') as f:
-                    protein_embeddings_file = {entry['protein_key']: entry for entry in json.load(f)}
-            else:
-                with open(fpath + f"proteins_{self.target_type}.json", 'r') as f:
-                    protein_embeddings_file = {entry['protein_key']: entry for entry in json.load(f)}
-
-        # Prepare lists of drugs, proteins, and their keys
-        drugs = []
-        prots = []
-        ligand_keys = []
-        protein_keys = []
-        protein_encodings = []
-        for d in ligands.keys():
-            lg = Chem.MolToSmiles(Chem.MolFromSmiles(ligands[d]),isomericSmiles=True)
-            drugs.append(lg)
-            ligand_keys.append(d)
-        for t in proteins.keys():
-            prots.append(proteins[t])
-            protein_keys.append(t)
-            if self.target_type == 'deepfri' or self.target_type == 'esm':
-                entry = protein_embeddings_file[t]
-                emb = entry['embedding']
-                protein_encodings.append(emb)
-        if self.dataset == 'davis':
-            affinity = [-np.log10(y/1e9) for y in affinity]
-        affinity = np.asarray(affinity)
-        rows, cols = np.where(np.isnan(affinity)==False)  
-
-        # Collect all protein-drug pairs for DataFrame
-        affinity_rows = []
-        for pair_ind in range(len(rows)):
-            prot = prots[cols[pair_ind]]
-            drug = drugs[rows[pair_ind]]
-            prot_key = protein_keys[cols[pair_ind]]
-            drug_key = ligand_keys[rows[pair_ind]]
-            aff = affinity[rows[pair_ind], cols[pair_ind]]
-            fold = index_to_fold.get(pair_ind, 'none')
-            if self.target_type == 'deepfri' or self.target_type == 'esm':
-                prot_encoding = protein_encodings[cols[pair_ind]]
-                affinity_rows.append({
-                    'target_sequence': prot,
-                    'compound_iso_smiles': drug,
-                    'affinity': aff,
-                    'drug_key': drug_key,
-                    'protein_key': prot_key,
-                    'protein_encoding': prot_encoding,
-                    'fold': fold
-                })
-            else:
-                affinity_rows.append({
-                    'target_sequence': prot,
-                    'compound_iso_smiles': drug,
-                    'affinity': aff,
-                    'drug_key': drug_key,
-                    'protein_key': prot_key,
-                    'fold': fold
-                })
-        dataset = pd.DataFrame(affinity_rows)
-        
-        drug_smiles = dataset['compound_iso_smiles'].values
-        target_sequences = dataset['target_sequence'].values
-        affinities = dataset['affinity'].values
-        folds = dataset['fold'].values
+            target_encodings = torch.from_numpy(protein_encodings)
+        else:
+            target_encodings = torch.from_numpy(seq_cat_batch(prots, dtype=np.uint8 if self.compact else np.int64))
+
+        # Gather the collated pair tensors directly with fancy indexing over the pair rows/cols
+        pair_drugs = torch.from_numpy(np.array([smiles_to_idx[smile] for smile in drugs], dtype=np.int64)[rows])
+        pair_nodes = num_nodes[pair_drugs]
+        pair_edges = num_edges[pair_drugs]
+        data = DATA.Data(x=drug_x[concat_ranges((num_nodes.cumsum(0) - num_nodes)[pair_drugs], pair_nodes)],
+                         edge_index=drug_edge_index[:, concat_ranges((num_edges.cumsum(0) - num_edges)[pair_drugs], pair_edges)],
+                         y=torch.FloatTensor(affinity[rows, cols]))
+        data.target = target_encodings[torch.from_numpy(cols.astype(np.int64))]
+        data.c_size = pair_nodes
+        data.fold = torch.from_numpy(pair_folds)
+
+        pair_ptr = torch.arange(len(rows) + 1)
+        slices = {
+            'x': torch.cat((torch.zeros(1, dtype=torch.long), pair_nodes.cumsum(0))),
+            'edge_index': torch.cat((torch.zeros(1, dtype=torch.long), pair_edges.cumsum(0))),
+            'y': pair_ptr,
+            'target': pair_ptr.clone(),
+            'c_size': pair_ptr.clone(),
+            'fold': pair_ptr.clone(),
+        }
+
+        if self.pre_filter is not None or self.pre_transform is not None:
+            self.data, self.slices = data, slices
+            data_list = [self.get(i) for i in range(len(rows))]
+            if self.pre_filter is not None:
+                data_list = [data for data in data_list if self.pre_filter(data)]
+            if self.pre_transform is not None:
+                data_list = [self.pre_transform(data) for data in data_list]
+            data, slices = self.collate(data_list)
+
+        save_atomic((data, slices), self.processed_paths[0])
+
+class DTAPairDataset(Dataset):
+    """Drug-target pairs stored as indexes into deduplicated drug graphs and protein targets.
+
+    Every unique protein target is stored once, and drug graphs come from the
+    DrugGraphStore shared by all datasets; each pair is a (drug_idx, prot_idx, y, fold)
+    row, and its `Data` object is assembled from those indexes when it is fetched by the loader.
+
+    Datasets whose raw directory holds an `affinities.csv` (see stream_affinity_csv)
+    instead of Y and folds are ingested `chunk_size` rows at a time, and their pair
+    arrays are memory-mapped from disk; `affinity_unit` is the unit of their affinity
+    column, 'pkd' (used as is) or 'kd' (Kd in nM, stored as -log10(Kd/1e9)). With `mmap`, the processed targets and pairs
+    are memory-mapped as well, and are shared by concurrent runs through the page cache.
+    Sequence targets are stored as uint8 codes, and are kept that way (and shared under `mmap`)
+    until expand_compact widens each batch; with `compact`, so are the drug atoms (as uint8
+    atom_feature_indices).
+    With `protein_lookup`, pairs carry a `prot_idx` instead of their target row, to be
+    gathered from the `target` table on the device (see models.common.set_protein_table).
+    to(device) makes the dataset resident on the device, where PairBatchLoader gathers its batches.
+    """
+    def __init__(self, root: str = 'data', dataset: str = 'davis', target_type: str = None, mutation: bool = False, num_workers: int = 0,
+                 chunk_size: int = 1000000, mmap: bool = False, compact: bool = False, protein_lookup: bool = False,
+                 affinity_unit: str = 'pkd'):
+        if affinity_unit not in AFFINITY_UNITS:
+            raise ValueError(f"Unknown affinity_unit: {affinity_unit}. Supported units are {', '.join(AFFINITY_UNITS)}.")
+
+        self.root = root
+        self.dataset = dataset
+
+        self.target_type = target_type
+        self.mutation = mutation
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.mmap = mmap
+        self.compact = compact
+        self.protein_lookup = protein_lookup
+        self.affinity_unit = affinity_unit
+
+        super().__init__(root, transform=None, pre_transform=None)
+
+        # The manifest of the raw data is saved in the processed file itself, so a run can never
+        # see a processed file together with the manifest of another build
+        self.manifest = self.raw_manifest()
+        previous = torch.load(self.processed_paths[0], mmap=True) if os.path.isfile(self.processed_paths[0]) else None
+        if previous is not None and previous.get('manifest') == self.manifest:
+            print('Pre-processed data found: {}, loading ...'.format(self.processed_paths[0]))
+        elif previous is not None:
+            print('Raw data changed since {} was built, updating ...'.format(self.processed_paths[0]))
+            self.remove_stale_splits()
+            self.process(self.manifest, previous=previous)
+        else:
+            print('Pre-processed data {} not found, doing pre-processing...'.format(self.processed_paths[0]))
+            self.remove_stale_splits()
+            self.process(self.manifest)
+        del previous
+        self.load(self.processed_paths[0])
+
+    @property
+    def raw_file_names(self):
+        return [os.path.join(self.root, self.dataset)]
+
+    def raw_manifest(self):
+        manifest = raw_manifest(self.raw_file_names[0] + '/', self.dataset, self.target_type, self.mutation)
+        if AFFINITY_CSV in manifest:
+            manifest['affinity_unit'] = self.affinity_unit
+        return manifest
+
+    @property
+    def processed_file_names(self):
+        processed_file_names = f"{self.dataset}"
+        processed_file_names += f"_{self.target_type}" if self.target_type else ""
+        processed_file_names += f"_mutation" if self.mutation else ""
+        processed_file_names += "_pairs.pt"
+        return [processed_file_names]
+
+    @property
+    def split_dir(self):
+        """Split indices of this build, named after its manifest, so other builds never remove them while in use."""
+        digest = hashlib.sha256(json.dumps(self.manifest, sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.splitext(self.processed_paths[0])[0] + f'_splits_{digest}'
+
+    def remove_stale_splits(self):
+        """Removes the split indices of earlier builds (and of the unversioned `_splits` directory)."""
+        prefix = os.path.basename(os.path.splitext(self.processed_paths[0])[0]) + '_splits'
+        for name in os.listdir(self.processed_dir):
+            path = os.path.join(self.processed_dir, name)
+            if (name == prefix or name.startswith(prefix + '_')) and path != self.split_dir:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def download(self):
+        pass
+
+    def _download(self):
+        pass
+
+    def _process(self):
+        if not os.path.exists(self.processed_dir):
+            os.makedirs(self.processed_dir)
+
+    def process(self, manifest, previous=None):
+        """Builds the processed pairs of the raw data with `manifest`, reusing the protein targets of a `previous` build that did not change."""
+        fpath = self.raw_file_names[0] + '/'
+        previous = previous or {}
+
+        store = DrugGraphStore(self.processed_dir, num_workers=self.num_workers)
+        streaming = os.path.isfile(fpath + AFFINITY_CSV)
+        if streaming:
+            drugs, prots, ligand_keys, protein_keys, protein_encodings = \
+                load_raw_entities(fpath, self.dataset, self.target_type, self.mutation,
+                                  canonical_smiles=store.canonical_smiles, store_dir=self.processed_dir)
+        else:
+            drugs, prots, ligand_keys, protein_keys, protein_encodings, affinity, rows, cols, pair_folds = \
+                load_raw_data(fpath, self.dataset, self.target_type, self.mutation,
+                              canonical_smiles=store.canonical_smiles, store_dir=self.processed_dir)
+
+        # Unique drugs; their graphs live in the shared drug graph store and are only featurized
+        # if no dataset featurized them before
+        unique_smiles = list(dict.fromkeys(drugs))
+        smiles_to_idx = {smile: i for i, smile in enumerate(unique_smiles)}
+        drug_map = np.array([smiles_to_idx[smile] for smile in drugs], dtype=np.int64)
+        store.graphs(unique_smiles)
+
+        # Protein targets, one row per protein; unchanged sequences keep their previous encoding
         if self.target_type == 'deepfri' or self.target_type == 'esm':
-            target_encodings = np.array(dataset['protein_encoding'])
-        elif self.target_type is None:
-            target_encodings = np.asarray([seq_cat(t) for t in target_sequences])
-        else:   
-            raise ValueError(f"Unknown target_type: {self.target_type}. Supported types are 'esm', 'deepfri', or None.")
-        # cluster_labels = dataset['cluster_number'].values if self.cluster_type else None
-
-        # Convert SMILES to graph data
-        smiles_set = set(drug_smiles)
-        graph_list = {}
-        for smile in smiles_set:
-            graph_list[smile] = smile_to_graph(smile)
-
-        assert (len(drug_smiles) == len(target_encodings) and len(target_encodings) == len(affinities)), \
-            "The three lists must be the same length!"
-
-        # Create PyTorch-Geometric data objects
-        data_len = len(target_sequences)
-        for i in tqdm(range(data_len), desc=f"Processing {self.dataset} data"):
-            smiles = drug_smiles[i]
-            target = target_encodings[i]
-            labels = affinities[i]
-            c_size, features, edge_index = graph_list[smiles]
-            fold = folds[i]
-            # cluster_number = cluster_labels[i] if self.cluster_type else -1
-            # protein_sequence = target_sequences[i]
-            
-            GCNData = DATA.Data(x=torch.Tensor(np.array(features)),
-                                edge_index=torch.LongTensor(edge_index).transpose(1, 0),
-                                y=torch.FloatTensor([labels]))
-            
-            GCNData.target = torch.FloatTensor([target]) \
-                if (self.target_type == 'esm' or self.target_type == 'deepfri') \
-                else torch.LongTensor(np.array([target]))
-            
-            GCNData.__setitem__('c_size', torch.LongTensor([c_size]))
-            GCNData.__setitem__('fold', torch.LongTensor([fold]))
-            # GCNData.__setitem__('cluster_number', torch.LongTensor([cluster_number]))
-            # GCNData.__setitem__('target_sequence', protein_sequence)
-
-            data_list.append(GCNData)
-
-        if self.pre_filter is not None:
-            data_list = [data for data in data_list if self.pre_filter(data)]
-
-        if self.pre_transform is not None:
-            data_list = [self.pre_transform(data) for data in data_list]
-
-        data, slices = self.collate(data_list)
-        torch.save((data, slices), self.processed_paths[0])
+            target = torch.from_numpy(protein_encodings)
+        else:
+            previous_prots = {prot: i for i, prot in enumerate(previous.get('protein_sequences', []))}
+            reused = np.array([previous_prots.get(prot, -1) for prot in prots], dtype=np.int64)
+            target = torch.zeros((len(prots), MAX_SEQ_LEN), dtype=torch.uint8)
+            if (reused >= 0).any():
+                target[torch.from_numpy(reused >= 0)] = previous['target'][torch.from_numpy(reused[reused >= 0])]
+            if (reused < 0).any():
+                target[torch.from_numpy(reused < 0)] = torch.from_numpy(seq_cat_batch([prots[i] for i in np.nonzero(reused < 0)[0]]))
+
+        # Pairs are rebuilt from the affinity matrix and folds, or streamed from the affinity CSV
+        if streaming:
+            pair_dir = os.path.splitext(self.processed_paths[0])[0]
+            stream_affinity_csv(fpath + AFFINITY_CSV, dict(zip(ligand_keys, drug_map)),
+                                {key: i for i, key in enumerate(protein_keys)}, pair_dir, chunk_size=self.chunk_size,
+                                kd_to_pkd=self.affinity_unit == 'kd')
+            pairs = {'pair_dir': os.path.basename(pair_dir)}
+        else:
+            pairs = {
+                'drug_idx': torch.from_numpy(drug_map[rows]),
+                'prot_idx': torch.from_numpy(cols.astype(np.int64)),
+                'y': torch.FloatTensor(affinity[rows, cols]),
+                'fold': torch.from_numpy(pair_folds),
+            }
+
+        save_atomic({
+            'target': target,
+            **pairs,
+            'drug_smiles': unique_smiles,
+            'ligand_keys': ligand_keys,
+            'protein_keys': protein_keys,
+            'protein_sequences': prots,
+            'manifest': manifest,
+        }, self.processed_paths[0])
+
+    def load(self, path):
+        storage = torch.load(path, mmap=self.mmap)
+        self.manifest = storage.pop('manifest')
+        if 'pair_dir' in storage:
+            pair_dir = os.path.join(os.path.dirname(path), storage.pop('pair_dir'))
+            for field in PAIR_FIELDS:
+                storage[field] = torch.from_numpy(np.load(os.path.join(pair_dir, f"{field}.npy"), mmap_mode='c'))
+        storage['drug_x'], storage['drug_edge_index'], storage['drug_x_ptr'], storage['drug_edge_ptr'] = \
+            DrugGraphStore(self.processed_dir, num_workers=self.num_workers, mmap=True).graphs(storage['drug_smiles'], compact=self.compact)
+        self.storage_keys = list(storage)
+        for key, value in storage.items():
+            setattr(self, key, value)
+
+    def to(self, device):
+        """Moves the flat pair, drug graph and target tensors to `device`, in place; views split afterwards index them there."""
+        if self._indices is not None:
+            raise ValueError("The given 'DTAPairDataset' only references a subset of the pairs of the full dataset")
+        for key in self.storage_keys:
+            value = getattr(self, key)
+            if isinstance(value, torch.Tensor):
+                setattr(self, key, value.to(device))
+        return self
+
+    def len(self):
+        return self.y.size(0)
+
+    def index_select(self, idx):
+        """Index views over integer/boolean tensors keep the indices as a tensor instead of a Python list."""
+        if isinstance(idx, np.ndarray) and idx.dtype in [np.int64, bool]:
+            idx = torch.from_numpy(idx)
+        if not isinstance(idx, torch.Tensor):
+            return super().index_select(idx)
+        if idx.dtype == torch.bool:
+            idx = idx.flatten().nonzero().flatten()
+        dataset = copy.copy(self)
+        dataset._indices = idx.flatten() if self._indices is None else torch.as_tensor(self._indices)[idx.flatten()]
+        return dataset
+
+    def split_indices(self, val_fold=None):
+        """Train/val/test pair indices, memory-mapped from `split_dir`.
+
+        Without a `val_fold` all folds are trained on and val is None; with one, that fold is
+        held out for validation. The test set is fold -1. Index files are computed from the
+        folds the first time a split is requested and reused by every later run.
+        """
+        split_name = 'full' if val_fold is None else f'fold_{val_fold}'
+        parts = ['train', 'test'] if val_fold is None else ['train', 'val', 'test']
+        paths = {part: os.path.join(self.split_dir, f'{split_name}_{part}.npy') for part in parts}
+        if not all(os.path.isfile(path) for path in paths.values()):
+            fold = self.fold.cpu().numpy()
+            masks = {'train': (fold >= 0) & (fold != val_fold), 'val': fold == val_fold, 'test': fold == -1}
+            os.makedirs(self.split_dir, exist_ok=True)
+            for part in parts:
+                tmp_path = paths[part][:-len('.npy')] + f'.{os.getpid()}.tmp.npy'
+                np.save(tmp_path, np.nonzero(masks[part])[0].astype(np.int64))
+                os.replace(tmp_path, paths[part])
+
+        return tuple(torch.from_numpy(np.load(paths[part], mmap_mode='c')) if part in paths else None
+                     for part in ['train', 'val', 'test'])
+
+    def split(self, val_fold=None):
+        """Zero-copy train/val/test views of the dataset, see split_indices; their indices live on the dataset's device."""
+        indices = self.split_indices(val_fold)
+        for part, idx in zip(['train', 'val', 'test'], indices):
+            if idx is not None and len(idx) == 0:
+                raise ValueError(f"The {part} split of {self.dataset} is empty (val_fold={val_fold}); "
+                                 f"folds present: {torch.unique(self.fold).tolist()}.")
+        return tuple(self.index_select(idx.to(self.y.device)) if idx is not None else None for idx in indices)
+
+    def get(self, idx):
+        d = int(self.drug_idx[idx])
+        p = int(self.prot_idx[idx])
+        x = self.drug_x[self.drug_x_ptr[d]:self.drug_x_ptr[d + 1]]
+        edge_index = self.drug_edge_index[:, self.drug_edge_ptr[d]:self.drug_edge_ptr[d + 1]]
+
+        GCNData = DATA.Data(x=x, edge_index=edge_index, y=self.y[idx:idx + 1])
+        if self.protein_lookup:
+            GCNData.prot_idx = self.prot_idx[idx:idx + 1]
+        else:
+            GCNData.target = self.target[p:p + 1]
+        GCNData.__setitem__('c_size', torch.LongTensor([x.size(0)]))
+        GCNData.__setitem__('fold', self.fold[idx:idx + 1])
+        return GCNData
+
+def load_raw_data(fpath, dataset, target_type=None, mutation=False, canonical_smiles=None, store_dir=None):
+    """Loads the raw ligands, proteins, protein encodings, affinities and folds of a dataset.
+
+    Returns the canonical drug SMILES, protein sequences, their keys, the protein
+    encodings (an [n_proteins, dim] array if target_type is 'esm' or 'deepfri'), the affinity matrix
+    (drugs x proteins), the row/column indices of the measured pairs and the fold of
+    each pair (-1 for the test set, -2 for pairs outside of the fold files).
+    SMILES already in the `canonical_smiles` dict are not re-canonicalized; new ones are added to it.
+    Legacy JSON protein embeddings are converted into `store_dir`, see load_embedding_store.
+    """
+    drugs, prots, ligand_keys, protein_keys, protein_encodings = \
+        load_raw_entities(fpath, dataset, target_type, mutation, canonical_smiles, store_dir)
+
+    # Load fold information
+    train_fold = json.load(open(fpath + "folds/train_fold_setting1.txt"))
+    test_fold = json.load(open(fpath + "folds/test_fold_setting1.txt"))
+
+    # Load affinity data
+    affinity = pickle.load(open(fpath + "Y","rb"), encoding='latin1')
+    if dataset == 'davis':
+        affinity = [-np.log10(y/1e9) for y in affinity]
+    affinity = np.asarray(affinity)
+    rows, cols = np.where(np.isnan(affinity)==False)
+
+    # Fold of each pair, indexed by the position of the pair in (rows, cols)
+    pair_folds = np.full(len(rows), -2, dtype=np.int64)
+    for fold_num, fold_indices in enumerate(train_fold):
+        pair_folds[fold_indices] = fold_num
+    pair_folds[test_fold] = -1
+
+    return drugs, prots, ligand_keys, protein_keys, protein_encodings, affinity, rows, cols, pair_folds
+
+def load_raw_entities(fpath, dataset, target_type=None, mutation=False, canonical_smiles=None, store_dir=None):
+    """Loads the raw ligands, proteins and protein encodings of a dataset, see load_raw_data."""
+    if target_type not in [None, 'esm', 'deepfri']:
+        raise ValueError(f"Unknown target_type: {target_type}. Supported types are 'esm', 'deepfri', or None.")
+
+    # Load ligands, proteins and protein encodings
+    ligands = json.load(open(fpath + "drugs.json"), object_pairs_hook=OrderedDict)
+    if mutation and dataset == 'davis':
+        proteins = json.load(open(fpath + "proteins_mutation.json"), object_pairs_hook=OrderedDict)
+    else:
+        proteins = json.load(open(fpath + "proteins.json"), object_pairs_hook=OrderedDict)
+
+    # Load precomputed protein embeddings
+    if target_type == 'deepfri' or target_type == 'esm':
+        embedding_keys, embeddings = load_embedding_store(embedding_store_path(fpath, dataset, target_type, mutation),
+                                                         cache_dir=store_dir)
+        embedding_rows = {key: i for i, key in enumerate(embedding_keys)}
+
+    # Prepare lists of drugs, proteins, and their keys
+    drugs = []
+    prots = []
+    ligand_keys = []
+    protein_keys = []
+    protein_encodings = []
+    if canonical_smiles is None:
+        canonical_smiles = {}
+    for d in ligands.keys():
+        if ligands[d] not in canonical_smiles:
+            canonical_smiles[ligands[d]] = Chem.MolToSmiles(Chem.MolFromSmiles(ligands[d]),isomericSmiles=True)
+        drugs.append(canonical_smiles[ligands[d]])
+        ligand_keys.append(d)
+    for t in proteins.keys():
+        prots.append(proteins[t])
+        protein_keys.append(t)
+    if target_type == 'deepfri' or target_type == 'esm':
+        protein_encodings = np.asarray(embeddings[[embedding_rows[t] for t in protein_keys]])
+
+    return drugs, prots, ligand_keys, protein_keys, protein_encodings
+
+AFFINITY_CSV = "affinities.csv"
+AFFINITY_UNITS = ['pkd', 'kd']
+PAIR_FIELDS = {'drug_idx': np.int64, 'prot_idx': np.int64, 'y': np.float32, 'fold': np.int64}
+# Training folds of the setting 1 splits; fold -1 is the test set
+NUM_FOLDS = 5
+
+def stream_affinity_csv(path, drug_rows, protein_rows, out_dir, chunk_size=1000000, kd_to_pkd=False, seed=0):
+    """Converts a COO affinity CSV into memory-mappable pair arrays, `chunk_size` rows at a time.
+
+    The CSV has drug_key, protein_key and affinity columns and an optional fold column.
+    Without it, every pair is assigned uniformly at random (with `seed`) to the test set
+    (-1) or one of NUM_FOLDS training folds, the proportions of the setting 1 splits.
+    `drug_rows`/`protein_rows` map keys to table indexes.
+    With `kd_to_pkd`, affinities are Kd values in nM and are stored as -log10(Kd/1e9),
+    as load_raw_data does for Davis.
+    Each chunk is written to its own shard before the next one is read, and the shards
+    are then copied one by one into <field>.npy files, so peak memory is bounded by
+    the chunk size instead of the number of measurements. The files are built in a
+    temporary directory and moved into `out_dir` when complete, so runs that have the
+    previous ones memory-mapped keep reading them.
+    """
+    tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+    shard_dir = os.path.join(tmp_dir, 'shards')
+    os.makedirs(shard_dir, exist_ok=True)
+    try:
+        rng = np.random.default_rng(seed)
+        shard_sizes = []
+        reader = pd.read_csv(path, chunksize=chunk_size, dtype={'drug_key': str, 'protein_key': str})
+        for shard, chunk in enumerate(tqdm(reader, desc="Streaming affinities", leave=False)):
+            drug_idx = chunk['drug_key'].map(drug_rows)
+            prot_idx = chunk['protein_key'].map(protein_rows)
+            unknown = drug_idx.isna() | prot_idx.isna()
+            if unknown.any():
+                row = chunk[unknown].iloc[0]
+                raise ValueError(f"Unknown drug or protein key in {path}: {row['drug_key']}, {row['protein_key']}.")
+            if 'fold' in chunk and chunk['fold'].isna().any():
+                row = chunk[chunk['fold'].isna()].iloc[0]
+                raise ValueError(f"Missing fold in {path}: {row['drug_key']}, {row['protein_key']}.")
+
+            y = chunk['affinity'].to_numpy(dtype=np.float64)
+            fields = {
+                'drug_idx': drug_idx.to_numpy(),
+                'prot_idx': prot_idx.to_numpy(),
+                'y': -np.log10(y / 1e9) if kd_to_pkd else y,
+                'fold': chunk['fold'].to_numpy() if 'fold' in chunk else rng.integers(-1, NUM_FOLDS, len(chunk)),
+            }
+            measured = ~np.isnan(fields['y'])
+            for field, dtype in PAIR_FIELDS.items():
+                np.save(os.path.join(shard_dir, f"{shard:05d}_{field}.npy"), fields[field][measured].astype(dtype))
+            shard_sizes.append(int(measured.sum()))
+
+        offsets = np.concatenate(([0], np.cumsum(shard_sizes)))
+        for field, dtype in PAIR_FIELDS.items():
+            out = np.lib.format.open_memmap(os.path.join(tmp_dir, f"{field}.npy"), mode='w+', dtype=dtype, shape=(int(offsets[-1]),))
+            for shard in range(len(shard_sizes)):
+                shard_path = os.path.join(shard_dir, f"{shard:05d}_{field}.npy")
+                out[offsets[shard]:offsets[shard + 1]] = np.load(shard_path)
+                os.remove(shard_path)
+            out.flush()
+            del out
+
+        os.makedirs(out_dir, exist_ok=True)
+        for field in PAIR_FIELDS:
+            os.replace(os.path.join(tmp_dir, f"{field}.npy"), os.path.join(out_dir, f"{field}.npy"))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return int(offsets[-1])
+
+def embedding_store_path(fpath, dataset, target_type, mutation=False):
+    if mutation and dataset == 'davis':
+        return fpath + f"proteins_{target_type}_mutation_"
+    return fpath + f"proteins_{target_type}"
+
+def file_sha256(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def raw_manifest(fpath, dataset, target_type=None, mutation=False):
+    """Content hashes of every raw input that a processed dataset is built from."""
+    if os.path.isfile(fpath + AFFINITY_CSV):
+        files = ["drugs.json", AFFINITY_CSV]
+    else:
+        files = ["drugs.json", "Y", "folds/train_fold_setting1.txt", "folds/test_fold_setting1.txt"]
+    files.append("proteins_mutation.json" if mutation and dataset == 'davis' else "proteins.json")
+    if target_type == 'deepfri' or target_type == 'esm':
+        store = os.path.basename(embedding_store_path(fpath, dataset, target_type, mutation))
+        if os.path.isfile(fpath + store + '.npy'):
+            files += [store + '.npy', store + '_keys.json']
+        else:
+            files.append(store + '.json')
+    return {f: file_sha256(fpath + f) for f in files}
+
+def load_manifest(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_atomic(obj, path, save=torch.save):
+    """`save(obj, tmp_path)` (torch.save by default) through a temporary file, so readers (and memory maps) of `path` never see a partial file."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+def save_manifest(path, manifest):
+    def write(manifest, tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=4)
+    save_atomic(manifest, path, save=write)
+
+def save_embedding_store(path, keys, embeddings):
+    """Writes protein embeddings as a float32 `<path>.npy` matrix and a `<path>_keys.json` row index.
+
+    Both files go through temporary files, the matrix last, so a reader that finds `<path>.npy` also finds its keys.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if len(keys) != embeddings.shape[0]:
+        raise ValueError(f"Got {len(keys)} keys for {embeddings.shape[0]} embeddings.")
+    tmp_path = f'{path}_keys.json.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(list(keys), f)
+    os.replace(tmp_path, path + '_keys.json')
+    tmp_path = f'{path}.npy.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, embeddings)
+    os.replace(tmp_path, path + '.npy')
+
+def load_embedding_store(path, mmap_mode='r', cache_dir=None):
+    """Opens the protein embedding store at `path`, memory-mapped, and returns its keys and matrix.
+
+    If only the legacy `<path>.json` records exist, they are converted once into a store in
+    `cache_dir` (next to them by default), named after their hash so edited records are converted again.
+    """
+    if not os.path.isfile(path + '.npy'):
+        cache_dir = cache_dir or os.path.dirname(path)
+        os.makedirs(cache_dir, exist_ok=True)
+        json_path = path + '.json'
+        path = os.path.join(cache_dir, f"{os.path.basename(path)}_{file_sha256(json_path)[:16]}")
+        if not os.path.isfile(path + '.npy'):
+            with open(json_path, 'r') as f:
+                entries = json.load(f)
+            print(f'Converting {json_path} into a binary embedding store ...')
+            save_embedding_store(path, [entry['protein_key'] for entry in entries], [entry['embedding'] for entry in entries])
+    with open(path + '_keys.json', 'r') as f:
+        keys = json.load(f)
+    return keys, np.load(path + '.npy', mmap_mode=mmap_mode)
 
 def atom_features(atom):
     return np.array(one_of_k_encoding_unk(atom.GetSymbol(),['C', 'N', 'O', 'S', 'F', 'Si', 'P', 'Cl', 'Br', 'Mg', 'Na','Ca', 'Fe', 'As', 'Al', 'I', 'B', 'V', 'K', 'Tl', 'Yb','Sb', 'Sn', 'Ag', 'Pd', 'Co', 'Se', 'Ti', 'Zn', 'H','Li', 'Ge', 'Cu', 'Au', 'Ni', 'Cd', 'In', 'Mn', 'Zr','Cr', 'Pt', 'Hg', 'Pb', 'Unknown']) +
@@ -219,36 +615,308 @@ def one_of_k_encoding_unk(x, allowable_set):
         x = allowable_set[-1]
     return list(map(lambda s: x == s, allowable_set))
 
-def smile_to_graph(smile):
+ATOM_SYMBOLS = ['C', 'N', 'O', 'S', 'F', 'Si', 'P', 'Cl', 'Br', 'Mg', 'Na','Ca', 'Fe', 'As', 'Al', 'I', 'B', 'V', 'K', 'Tl', 'Yb','Sb', 'Sn', 'Ag', 'Pd', 'Co', 'Se', 'Ti', 'Zn', 'H','Li', 'Ge', 'Cu', 'Au', 'Ni', 'Cd', 'In', 'Mn', 'Zr','Cr', 'Pt', 'Hg', 'Pb', 'Unknown']
+ATOM_SYMBOL_DICT = {v:i for i,v in enumerate(ATOM_SYMBOLS)}
+# Largest one-hot index of the degree, H count and implicit valence features
+MAX_FEATURE_INDEX = 10
+# Column offsets of the symbol, degree, H count and implicit valence blocks; aromaticity is the last column
+ATOM_FEATURE_OFFSETS = np.array([0, 44, 55, 66])
+NUM_ATOM_FEATURES = 78
+
+def atom_feature_indices(mol):
+    """Per-atom symbol, degree, H count, implicit valence and aromaticity as an [n_atoms, 5] integer array."""
+    unknown = len(ATOM_SYMBOLS) - 1
+    indices = np.array([(ATOM_SYMBOL_DICT.get(atom.GetSymbol(), unknown),
+                         atom.GetDegree(),
+                         atom.GetTotalNumHs(),
+                         atom.GetImplicitValence(),
+                         atom.GetIsAromatic()) for atom in mol.GetAtoms()], dtype=np.int64).reshape(-1, 5)
+    if (indices[:, 1] > MAX_FEATURE_INDEX).any():
+        degree = indices[indices[:, 1] > MAX_FEATURE_INDEX, 1][0]
+        raise Exception("input {0} not in allowable set{1}:".format(degree, list(range(MAX_FEATURE_INDEX + 1))))
+    # H count and implicit valence map values outside the allowable set to the last element
+    np.minimum(indices[:, 2:4], MAX_FEATURE_INDEX, out=indices[:, 2:4])
+    return indices
+
+def atom_feature_matrix(indices):
+    """Builds the normalised one-hot atom features of atom_features from atom_feature_indices."""
+    features = np.zeros((indices.shape[0], NUM_ATOM_FEATURES))
+    features[np.arange(indices.shape[0])[:, None], indices[:, :4] + ATOM_FEATURE_OFFSETS] = 1
+    features[:, -1] = indices[:, 4]
+    return features / features.sum(1, keepdims=True)
+
+def atom_feature_tensor(indices):
+    """Torch atom_feature_matrix: rebuilds float32 atom features from (uint8) atom_feature_indices on their device."""
+    indices = indices.long()
+    features = torch.zeros((indices.size(0), NUM_ATOM_FEATURES), device=indices.device)
+    features.scatter_(1, indices[:, :4] + torch.as_tensor(ATOM_FEATURE_OFFSETS, device=indices.device), 1)
+    features[:, -1] = indices[:, 4]
+    return features / features.sum(1, keepdim=True)
+
+def expand_compact(data):
+    """Expands the uint8 atom feature indices and sequence codes of a compact batch into the float/long tensors the models take."""
+    if data.x.dtype == torch.uint8:
+        data.x = atom_feature_tensor(data.x)
+    if 'target' in data and data.target.dtype == torch.uint8:
+        data.target = data.target.long()
+    return data
+
+def smile_to_graph(smile, compact=False):
+    """Graph of a SMILES; with `compact`, atoms are [n_atoms, 5] uint8 atom_feature_indices instead of one-hot features."""
     mol = Chem.MolFromSmiles(smile)
     
     c_size = mol.GetNumAtoms()
     
-    features = []
-    for atom in mol.GetAtoms():
-        feature = atom_features(atom)
-        features.append( feature / sum(feature) )
-
-    edges = []
-    for bond in mol.GetBonds():
-        edges.append([bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()])
-    g = nx.Graph(edges).to_directed()
-    edge_index = []
-    for e1, e2 in g.edges:
-        edge_index.append([e1, e2])
+    if compact:
+        features = atom_feature_indices(mol).astype(np.uint8)
+    else:
+        features = atom_feature_matrix(atom_feature_indices(mol))
+
+    bonds = np.array([(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()) for bond in mol.GetBonds()], dtype=np.int64)
+    edge_index = bond_edge_index(bonds)
         
     return c_size, features, edge_index     
 
+def bond_edge_index(bonds):
+    """Expands [n_bonds, 2] atom index pairs into both edge directions, as an [2 * n_bonds, 2] array.
+
+    Edges are grouped by source atom, atoms ordered by their first appearance in the bond
+    list and each atom's edges kept in bond order (the order networkx to_directed produced).
+    """
+    bonds = bonds.reshape(-1, 2)
+    src = bonds.reshape(-1)
+    dst = bonds[:, ::-1].reshape(-1)
+    if len(src) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    atoms, first_seen = np.unique(src, return_index=True)
+    atom_order = np.zeros(atoms[-1] + 1, dtype=np.int64)
+    atom_order[atoms] = first_seen
+    order = np.argsort(atom_order[src], kind='stable')
+    return np.stack((src[order], dst[order]), axis=1)
+
+def concat_ranges(starts, counts):
+    """Concatenation of arange(start, start + count) for every start/count pair, as one index tensor."""
+    total = int(counts.sum())
+    offsets = counts.cumsum(0) - counts
+    return torch.arange(total, device=counts.device) + torch.repeat_interleave(starts - offsets, counts, output_size=total)
+
+def smiles_to_graphs(smiles, num_workers=0, chunksize=None, compact=False):
+    """Featurizes a list of SMILES with smile_to_graph, optionally across a process pool.
+
+    The SMILES are sharded into chunks of `chunksize` and handed to `num_workers`
+    processes; graphs are always returned in the order of `smiles`, so the result
+    does not depend on the number of workers.
+    """
+    smiles = list(smiles)
+    if num_workers is None or num_workers <= 1 or len(smiles) < 2:
+        return [smile_to_graph(smile, compact) for smile in tqdm(smiles, desc="Featurizing drugs", leave=False)]
+
+    if chunksize is None:
+        chunksize = max(1, len(smiles) // (4 * num_workers))
+    with Pool(processes=num_workers) as pool:
+        graphs = list(tqdm(pool.imap(partial(smile_to_graph, compact=compact), smiles, chunksize=chunksize),
+                           total=len(smiles), desc="Featurizing drugs", leave=False))
+    return graphs
+
+# Bump whenever atom_feature_indices/atom_feature_matrix or bond_edge_index change, so stale stores are not reused
+DRUG_FEATURIZER_VERSION = 2
+
+class DrugGraphStore:
+    """Persistent drug graphs keyed by canonical SMILES, shared by every dataset in a processed dir.
+
+    Raw SMILES are canonicalized and featurized at most once per store; graphs are
+    only ever appended, to `drug_graphs_v<DRUG_FEATURIZER_VERSION>.pt`. Atoms are
+    stored as uint8 atom_feature_indices. With `mmap`, the store is memory-mapped instead of read.
+    """
+    def __init__(self, processed_dir, num_workers=0, mmap=False):
+        self.path = os.path.join(processed_dir, f'drug_graphs_v{DRUG_FEATURIZER_VERSION}.pt')
+        self.num_workers = num_workers
+        self.mmap = mmap
+        self.storage = self.read()
+        self.saved_canonical = len(self.canonical_smiles)
+
+    def read(self):
+        if os.path.isfile(self.path):
+            return torch.load(self.path, mmap=self.mmap)
+        return {
+            'canonical_smiles': {},
+            'smiles': [],
+            'x': torch.zeros((0, 5), dtype=torch.uint8),
+            'edge_index': torch.zeros((2, 0), dtype=torch.long),
+            'x_ptr': torch.zeros(1, dtype=torch.long),
+            'edge_ptr': torch.zeros(1, dtype=torch.long),
+        }
+
+    @property
+    def canonical_smiles(self):
+        """Raw to canonical SMILES; load_raw_entities adds the SMILES it canonicalizes to it."""
+        return self.storage['canonical_smiles']
+
+    def add(self, smiles, graphs):
+        storage = self.storage
+        storage['smiles'] = storage['smiles'] + list(smiles)
+        storage['x'] = torch.cat([storage['x']] + [torch.from_numpy(np.asarray(features, dtype=np.uint8)).view(c_size, -1) for c_size, features, _ in graphs], 0)
+        storage['edge_index'] = torch.cat([storage['edge_index']] + [torch.LongTensor(edge_index).view(-1, 2).transpose(1, 0) for _, _, edge_index in graphs], 1)
+        storage['x_ptr'] = torch.cat((storage['x_ptr'], storage['x_ptr'][-1] + torch.LongTensor([c_size for c_size, _, _ in graphs]).cumsum(0)))
+        storage['edge_ptr'] = torch.cat((storage['edge_ptr'], storage['edge_ptr'][-1] + torch.LongTensor([len(edge_index) for _, _, edge_index in graphs]).cumsum(0)))
+
+    def save(self):
+        # Merge in whatever other processes saved since this store was read, then swap the file in atomically
+        on_disk = self.read()
+        rows = {smile: i for i, smile in enumerate(self.storage['smiles'])}
+        missing = [i for i, smile in enumerate(on_disk['smiles']) if smile not in rows]
+        if missing:
+            x_ptr, edge_ptr = on_disk['x_ptr'], on_disk['edge_ptr']
+            self.add([on_disk['smiles'][i] for i in missing],
+                     [(int(x_ptr[i + 1] - x_ptr[i]), on_disk['x'][x_ptr[i]:x_ptr[i + 1]].numpy(),
+                       on_disk['edge_index'][:, edge_ptr[i]:edge_ptr[i + 1]].t().numpy()) for i in missing])
+        self.storage['canonical_smiles'] = {**on_disk['canonical_smiles'], **self.storage['canonical_smiles']}
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        save_atomic(self.storage, self.path)
+        self.saved_canonical = len(self.canonical_smiles)
+
+    def graphs(self, smiles, compact=False):
+        """Concatenated graphs of a list of canonical SMILES, featurizing and storing the ones not seen before.
+
+        Returns node features (uint8 atom_feature_indices if `compact`), edge indices local to each
+        graph, and the node/edge offsets of every graph.
+        """
+        rows = {smile: i for i, smile in enumerate(self.storage['smiles'])}
+        new_smiles = list(dict.fromkeys(smile for smile in smiles if smile not in rows))
+        if new_smiles:
+            self.add(new_smiles, smiles_to_graphs(new_smiles, num_workers=self.num_workers, compact=True))
+            self.save()
+            rows = {smile: i for i, smile in enumerate(self.storage['smiles'])}
+        elif len(self.canonical_smiles) > self.saved_canonical:
+            self.save()
+
+        idx = torch.LongTensor([rows[smile] for smile in smiles])
+        x_ptr, edge_ptr = self.storage['x_ptr'], self.storage['edge_ptr']
+        num_nodes = x_ptr[idx + 1] - x_ptr[idx]
+        num_edges = edge_ptr[idx + 1] - edge_ptr[idx]
+        x = self.storage['x'][concat_ranges(x_ptr[idx], num_nodes)]
+        if not compact:
+            x = atom_feature_tensor(x)
+        edge_index = self.storage['edge_index'][:, concat_ranges(edge_ptr[idx], num_edges)]
+        return x, edge_index, torch.cat((torch.zeros(1, dtype=torch.long), num_nodes.cumsum(0))), \
+            torch.cat((torch.zeros(1, dtype=torch.long), num_edges.cumsum(0)))
+
 SEQ_VOC = "ABCDEFGHIKLMNOPQRSTUVWXYZ"
 SEQ_DICT = {v:(i+1) for i,v in enumerate(SEQ_VOC)}
 SEQ_DICT_LEN = len(SEQ_DICT)
 MAX_SEQ_LEN = 1000
 
+# Byte lookup table from residue characters to SEQ_DICT codes; 0 is padding, SEQ_UNKNOWN marks residues outside SEQ_VOC
+SEQ_UNKNOWN = 255
+SEQ_LUT = np.full(256, SEQ_UNKNOWN, dtype=np.uint8)
+SEQ_LUT[0] = 0
+for ch, code in SEQ_DICT.items():
+    SEQ_LUT[ord(ch)] = code
+
 def seq_cat(prot):
-    x = np.zeros(MAX_SEQ_LEN)
-    for i, ch in enumerate(prot[:MAX_SEQ_LEN]): 
-        x[i] = SEQ_DICT[ch]
-    return x
+    return seq_cat_batch([prot])[0].astype(np.float64)
+
+def seq_cat_batch(prots, unknown=None, dtype=np.uint8):
+    """Encodes protein sequences into an [N, MAX_SEQ_LEN] matrix of SEQ_DICT codes, zero-padded.
+
+    Residues outside SEQ_VOC raise a ValueError, unless `unknown` gives the code to store for them,
+    one of the 0..SEQ_DICT_LEN codes the models embed.
+    """
+    if unknown is not None:
+        if not 0 <= unknown <= SEQ_DICT_LEN:
+            raise ValueError(f"unknown={unknown} is not a sequence code, expected 0 to {SEQ_DICT_LEN}.")
+        if np.issubdtype(dtype, np.integer) and not np.iinfo(dtype).min <= unknown <= np.iinfo(dtype).max:
+            raise ValueError(f"unknown={unknown} does not fit in {np.dtype(dtype)}.")
+    padded = ''.join(prot[:MAX_SEQ_LEN].ljust(MAX_SEQ_LEN, '\0') for prot in prots)
+    residues = np.frombuffer(padded.encode('ascii', errors='replace'), dtype=np.uint8).reshape(len(prots), MAX_SEQ_LEN)
+    codes = SEQ_LUT[residues]
+
+    unknown_mask = codes == SEQ_UNKNOWN
+    if unknown_mask.any():
+        if unknown is None:
+            rows = np.unique(np.nonzero(unknown_mask)[0])
+            chars = sorted(set(''.join(prots[i][:MAX_SEQ_LEN][j] for i, j in zip(*np.nonzero(unknown_mask)))))
+            raise ValueError(f"Unknown residues {chars} in protein sequences {rows.tolist()}; "
+                             f"pass unknown=<code> to encode them.")
+    codes = codes.astype(dtype, copy=False)
+    if unknown_mask.any():
+        codes[unknown_mask] = unknown
+    return codes
+
+def seed_everything(seed):
+    """Seeds Python, NumPy and torch (CPU and CUDA), and makes torch and cuDNN deterministic."""
+    print("Seed: " + str(seed))
+    os.environ["CUBLAS_WORKSPACE_CONFIG"]=":4096:8"
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = True
+    torch.use_deterministic_algorithms(True)
+
+class EarlyStopping:
+    """Early stopping on a metric that should decrease (`mode='min'`) or increase (`mode='max'`).
+
+    step(value) returns whether the value improved on the best one by more than
+    `min_delta`; `stop` is set once it has not for `patience` epochs in a row (never
+    with patience 0). A NaN value (e.g. the Pearson correlation of constant predictions)
+    never improves, and is never kept as the best one.
+    """
+    def __init__(self, patience=0, min_delta=0.0, mode='min'):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.sign = 1 if mode == 'min' else -1
+        self.best = None
+        self.bad_epochs = 0
+        self.stop = False
+
+    def step(self, value):
+        if not np.isnan(value) and (self.best is None or self.sign * (self.best - value) > self.min_delta):
+            self.best = value
+            self.bad_epochs = 0
+            return True
+        self.bad_epochs += 1
+        self.stop = self.patience > 0 and self.bad_epochs >= self.patience
+        return False
+
+def amp_dtype(amp, device):
+    """Autocast dtype of an --amp mode ('bf16'/'fp16', None for fp32) on `device`.
+
+    fp16 autocast is only used on CUDA (with a GradScaler); CPUs, and GPUs without bf16
+    support, fall back to the other half type.
+    """
+    if amp is None:
+        return None
+    if amp == 'fp16' and device.type != 'cuda':
+        print('fp16 autocast needs CUDA, using bf16')
+        return torch.bfloat16
+    if amp == 'bf16' and device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        print('bf16 is not supported on this GPU, using fp16')
+        return torch.float16
+    return {'bf16': torch.bfloat16, 'fp16': torch.float16}[amp]
+
+def compile_model(model):
+    """torch.compile(model), for dynamic batch shapes.
+
+    Model config such as num_layers is constant to the compiler, so the per-depth branches
+    of forward are resolved when tracing. Code that fails to compile (e.g. PyG ops without
+    compiler support) runs eagerly instead of failing the run, as does the whole model
+    where torch.compile is unavailable. The compiler settings this needs are patched in
+    around the calls of the compiled model only, as it compiles lazily when first called,
+    and do not affect anything else compiled in the process.
+    """
+    try:
+        import torch._dynamo
+        compiled = torch.compile(model, dynamic=True)
+        # PyG pooling sizes its output with int(batch.max()) + 1, which would otherwise split the graph
+        compiled.forward = torch._dynamo.config.patch(suppress_errors=True, capture_scalar_outputs=True)(compiled.forward)
+        return compiled
+    except Exception as e:
+        print(f'torch.compile unavailable ({e}), running eagerly')
+        return model
 
 def rmse(y,f):
     rmse = sqrt(((y - f)**2).mean(axis=0))